@@ -0,0 +1,144 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Локальная заглушка Telegram Bot API для нагрузочных тестов.
+# Принимает запросы вида /bot<token>/<method>, запоминает их и может отвечать ошибками 429/403.
+# Бот направляется сюда через TELEGRAM_API_URL=http://127.0.0.1:<port>/bot{0}/{1}
+
+MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument'}
+
+
+class FakeTelegramServer:
+    def __init__(self, host='127.0.0.1', port=0, fail_403=0.0, fail_429=0.0, retry_after=1, latency=0.0, seed=0):
+        self.fail_403 = fail_403
+        self.fail_429 = fail_429
+        self.retry_after = retry_after
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.statuses = Counter()
+        self.markups = {}  # chat_id -> последняя отправленная клавиатура (JSON)
+        self.message_id = 0
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.statuses.clear()
+
+    def last_callback_data(self, chat_id):
+        # callback_data первой кнопки последней inline-клавиатуры, отправленной в чат
+        markup = json.loads(self.markups.get(str(chat_id), '{}'))
+        rows = markup.get('inline_keyboard') or [[]]
+        return rows[0][0]['callback_data'] if rows[0] else None
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls), Counter(self.statuses)
+
+    def respond(self, method, params):
+        # Возвращает (HTTP-статус, тело ответа) для вызова метода Bot API
+        with self.lock:
+            self.calls[method] += 1
+            if params.get('reply_markup'):
+                self.markups[params.get('chat_id')] = params['reply_markup']
+            roll = self.random.random()
+            self.message_id += 1
+            message_id = self.message_id
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method in MESSAGE_METHODS and roll < self.fail_429:
+            status, body = 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry later',
+                                 'parameters': {'retry_after': self.retry_after}}
+        elif method in MESSAGE_METHODS and roll < self.fail_429 + self.fail_403:
+            status, body = 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+        elif method in MESSAGE_METHODS:
+            chat_id = int(params.get('chat_id') or 0)
+            status, body = 200, {'ok': True, 'result': {
+                'message_id': int(params.get('message_id') or message_id),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }}
+        elif method == 'getMe':
+            status, body = 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}}
+        else:
+            status, body = 200, {'ok': True, 'result': True}
+
+        with self.lock:
+            self.statuses[(method, status)] += 1
+        return status, body
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # иначе заголовки и тело ответа на keep-alive соединении расходятся на 40 мс
+
+            def handle_request(self):
+                url = urlsplit(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                if body and self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update(parse_qsl(body.decode('utf-8')))
+                status, response = fake.respond(method, params)
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = handle_request
+            do_POST = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--fail-403', type=float, default=0.0, help="доля ответов 403 (бот заблокирован)")
+    parser.add_argument('--fail-429', type=float, default=0.0, help="доля ответов 429 (превышен лимит)")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа, секунды")
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(port=args.port, fail_403=args.fail_403, fail_429=args.fail_429,
+                                retry_after=args.retry_after, latency=args.latency)
+    print(f"TELEGRAM_API_URL={server.api_url}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
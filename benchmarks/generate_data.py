@@ -0,0 +1,85 @@
+import datetime
+import os
+import random
+import time
+
+# Наполнение базы синтетическими данными для нагрузочных тестов:
+#   python -m benchmarks.generate_data --database-url sqlite:///bench.db --users 100000 --payments 2000000
+
+FIRST_USER_ID = 1000
+BATCH_SIZE = 50000
+
+
+def generate(database_url, users, payments, seed=0, paid_share=0.7, pending_share=0.1, rejected_share=0.05):
+    # Схема создается самим ботом, поэтому модуль bot импортируется после настройки окружения
+    os.environ.setdefault('BOT_TOKEN', '0:benchmark')
+    os.environ.setdefault('ADMIN_ID', '1')
+    os.environ['DATABASE_URL'] = database_url
+    import bot
+    from sqlalchemy import insert
+
+    rng = random.Random(seed)
+    now = datetime.datetime.now()
+    current_key = bot.month_to_key(now.strftime('%Y-%m'))
+    started = time.monotonic()
+
+    with bot.engine.begin() as connection:
+        for start in range(0, users, BATCH_SIZE):
+            connection.execute(insert(bot.User.__table__), [
+                {'id': FIRST_USER_ID + i, 'username': f"user{i}"}
+                for i in range(start, min(start + BATCH_SIZE, users))
+            ])
+
+    per_user, extra = divmod(payments, users)
+    batch = []
+    inserted = 0
+    with bot.engine.begin() as connection:
+        for i in range(users):
+            count = per_user + (1 if i < extra else 0)
+            if not count:
+                continue
+            # Часть пользователей не оплатила текущий месяц, последняя оплата может ждать проверки или быть отклонена
+            last_key = current_key if rng.random() < paid_share else current_key - 1
+            roll = rng.random()
+            for month_key in range(last_key - count + 1, last_key + 1):
+                month = bot.key_to_month(month_key)
+                is_last = month_key == last_key
+                batch.append({
+                    'user_id': FIRST_USER_ID + i,
+                    'payment_date': datetime.datetime.strptime(month, '%Y-%m'),
+                    'amount': 100,
+                    'confirmed': not (is_last and roll < pending_share + rejected_share),
+                    'rejected': is_last and roll < rejected_share,
+                    'comment': None,
+                    'month': month,
+                    'month_key': month_key,
+                })
+            if len(batch) >= BATCH_SIZE:
+                connection.execute(insert(bot.Payment.__table__), batch)
+                inserted += len(batch)
+                batch = []
+        if batch:
+            connection.execute(insert(bot.Payment.__table__), batch)
+            inserted += len(batch)
+
+    # Данные вставлены в обход обработчиков бота, поэтому сводка subscriptions строится целиком
+    with bot.engine.begin() as connection:
+        bot.rebuild_subscriptions(connection)
+
+    if bot.engine.dialect.name == 'sqlite':
+        with bot.engine.begin() as connection:
+            connection.exec_driver_sql('ANALYZE')
+    print(f"Создано пользователей: {users}, оплат: {inserted} за {time.monotonic() - started:.1f} с")
+    return [FIRST_USER_ID + i for i in range(users)]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Генерация тестовых данных")
+    parser.add_argument('--database-url', default='sqlite:///bench.db')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--payments', type=int, default=2000000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate(args.database_url, args.users, args.payments, seed=args.seed)
@@ -0,0 +1,364 @@
+import datetime
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+from benchmarks.fake_telegram import FakeTelegramServer
+from benchmarks.generate_data import FIRST_USER_ID, generate
+
+# Сценарные замеры бота против локальной заглушки Bot API:
+#   python -m benchmarks.run --users 100000 --payments 2000000
+#   python -m benchmarks.run --database-url sqlite:///bench.db --scenarios callbacks,admin
+# Для каждого сценария выводятся p50/p99 задержки обработки апдейта, число SQL-запросов
+# на апдейт (или на сообщение для фоновых рассылок) и скорость отправки сообщений.
+
+ADMIN_ID = 1
+SCENARIOS = ['callbacks', 'admin', 'broadcast', 'reminders', 'webhook', 'plans']
+
+
+class QueryCounter:
+    # Считает SQL-запросы, выполненные текущим потоком
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.local = threading.local()
+        self.total = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+        self.local.last = (statement, parameters)
+        with self.lock:
+            self.total += 1
+
+    def reset(self):
+        self.local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+    @property
+    def last(self):
+        return getattr(self.local, 'last', None)
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+class Benchmark:
+    def __init__(self, bot_module, server, users, rng):
+        self.bot = bot_module
+        self.server = server
+        self.users = users
+        self.rng = rng
+        self.queries = QueryCounter(bot_module.engine)
+        self.update_ids = itertools.count(1)
+
+    def message(self, user_id, text):
+        return {'update_id': next(self.update_ids), 'message': {
+            'message_id': next(self.update_ids), 'date': int(time.time()), 'text': text,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f"user{user_id}"},
+        }}
+
+    def callback(self, user_id, data):
+        return {'update_id': next(self.update_ids), 'callback_query': {
+            'id': str(next(self.update_ids)), 'chat_instance': '1', 'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f"user{user_id}"},
+            'message': {'message_id': 1, 'date': int(time.time()), 'text': '-', 'chat': {'id': user_id, 'type': 'private'}},
+        }}
+
+    def process(self, update, samples):
+        from telebot.types import Update
+        self.queries.reset()
+        started = time.perf_counter()
+        self.bot.bot.process_new_updates([Update.de_json(update)])
+        samples.append((time.perf_counter() - started, self.queries.count))
+
+    def sent_messages(self):
+        calls, _ = self.server.snapshot()
+        return sum(calls[method] for method in ('sendMessage', 'sendDocument'))
+
+    def report(self, name, samples, elapsed, messages, unit='апдейт'):
+        latencies = [latency * 1000 for latency, _ in samples]
+        queries = sum(count for _, count in samples) / max(len(samples), 1)
+        print(f"{name:<12} {len(samples):>7} {unit:<10} p50 {percentile(latencies, 0.5):8.2f} мс  "
+              f"p99 {percentile(latencies, 0.99):8.2f} мс  SQL/{unit} {queries:6.2f}  "
+              f"{messages / max(elapsed, 1e-9):8.1f} сообщ./с  ({elapsed:.1f} с)")
+
+    def run_updates(self, name, updates):
+        self.server.reset()
+        samples = []
+        started = time.perf_counter()
+        for update in updates:
+            if callable(update):
+                update = update()
+                if update is None:
+                    continue
+            self.process(update, samples)
+        self.report(name, samples, time.perf_counter() - started, self.sent_messages())
+
+    def callbacks(self, count):
+        # Типичный сеанс пользователя: статус, выбор периода, выбор месяцев, "Оплатил"
+        next_month = (datetime.datetime.now().replace(day=1) + datetime.timedelta(days=32)).strftime('%Y-%m')
+        updates = []
+        for user_id in self.rng.sample(self.users, min(count, len(self.users))):
+            updates.append(self.message(user_id, "📊 Статус"))
+            updates.append(self.message(user_id, "💰 Оплатить"))
+            updates.append(self.callback(user_id, f"pay_{self.rng.randint(1, 12)}_{next_month}"))
+            updates.append(lambda user_id=user_id: self.paid_callback(user_id))
+        self.run_updates('callbacks', updates)
+
+    def paid_callback(self, user_id):
+        data = self.server.last_callback_data(user_id)
+        return self.callback(user_id, data) if data and data.startswith('paid:') else None
+
+    def admin(self, repeat):
+        updates = []
+        for _ in range(repeat):
+            for text in ("📈 Статистика оплат", "🔍 Неоплатившие пользователи", "❌ Удалить оплаты",
+                         "✅ Подтвердить оплаты", "👥 Список пользователей"):
+                updates.append(self.message(ADMIN_ID, text))
+            updates.append(self.callback(ADMIN_ID, 'stats_users:new'))
+            updates.append(self.callback(ADMIN_ID, 'stats_csv'))
+        self.run_updates('admin', updates)
+
+    def broadcast(self):
+        self.server.reset()
+        self.queries.total = 0
+        from sqlalchemy import func, select
+        with self.bot.session_scope() as session:
+            last_job_id = session.scalar(select(func.max(self.bot.BroadcastJob.id)))
+        # Рассылка запускается так же, как администратором: кнопка, затем текст уведомления
+        samples = []
+        started = time.perf_counter()
+        self.process(self.message(ADMIN_ID, "📢 Отправить уведомление"), samples)
+        self.process(self.message(ADMIN_ID, "Тестовая рассылка"), samples)
+        with self.bot.session_scope() as session:
+            job_id = session.scalar(select(func.max(self.bot.BroadcastJob.id)))
+        if job_id == last_job_id or self.bot.chat_states.get(ADMIN_ID) is not None:
+            raise RuntimeError("Рассылка не запустилась из апдейтов администратора")
+        while self.bot.get_broadcast_counts(job_id).get('pending'):
+            time.sleep(0.2)
+        elapsed = time.perf_counter() - started
+        sent = self.sent_messages()
+        self.report('broadcast', [(elapsed / max(sent, 1), self.queries.total / max(sent, 1))] * max(sent, 1),
+                    elapsed, sent, unit='сообщение')
+
+    def reminders(self):
+        self.server.reset()
+        self.queries.total = 0
+        self.bot.completed_reminders.clear()
+        now = datetime.datetime.now().replace(day=self.bot.REMINDER_DAYS[0])
+        started = time.perf_counter()
+        self.bot.send_reminders(now)
+        elapsed = time.perf_counter() - started
+        sent = self.sent_messages()
+        self.report('reminders', [(elapsed / max(sent, 1), self.queries.total / max(sent, 1))] * max(sent, 1),
+                    elapsed, sent, unit='сообщение')
+
+    def start_webhook(self, pool):
+        # Приемник вебхука бота на свободном порту с заданным пулом обработки
+        from http.server import ThreadingHTTPServer
+        server = ThreadingHTTPServer(('127.0.0.1', 0), self.bot.WebhookHandler)
+        server.daemon_threads = True
+        server.update_pool = pool
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def post_update(self, server, update):
+        # (HTTP-статус, Retry-After, задержка) для одного апдейта, отправленного как это делает Telegram
+        import http.client
+        import json
+        connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+        started = time.perf_counter()
+        connection.request('POST', self.bot.WEBHOOK_PATH, json.dumps(update), {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        return response.status, response.getheader('Retry-After'), time.perf_counter() - started
+
+    def webhook(self, count, per_chat=4, senders=8):
+        # Апдейты POST-запросами в WebhookHandler: ответы 200, порядок обработки внутри чата
+        # совпадает с порядком отправки, переполненная очередь отвечает 503 с Retry-After
+        from collections import Counter, defaultdict
+        processed = defaultdict(list)
+        lock = threading.Lock()
+        process_new_updates = self.bot.bot.process_new_updates
+        gate = threading.Event()  # снят - обработчик останавливается на апдейте, blocked сообщает об этом
+        blocked = threading.Event()
+        gate.set()
+
+        def record(updates):
+            if not gate.is_set():
+                blocked.set()
+                gate.wait()
+            with lock:
+                for update in updates:
+                    processed[update.message.chat.id].append(update.update_id)
+            return process_new_updates(updates)
+
+        self.bot.bot.process_new_updates = record
+        try:
+            self.server.reset()
+            self.queries.total = 0
+            chats = self.rng.sample(self.users, min(max(count // per_chat, 1), len(self.users)))
+            sent = {chat_id: [self.message(chat_id, "📊 Статус") for _ in range(per_chat)] for chat_id in chats}
+            server = self.start_webhook(self.bot.UpdateWorkerPool(self.bot.WEBHOOK_WORKERS, self.bot.WEBHOOK_QUEUE_SIZE))
+            samples = []
+            statuses = Counter()
+
+            def send(chat_ids):
+                for chat_id in chat_ids:
+                    for update in sent[chat_id]:
+                        status, _, latency = self.post_update(server, update)
+                        with lock:
+                            statuses[status] += 1
+                            samples.append((latency, 0))
+
+            started = time.perf_counter()
+            threads = [threading.Thread(target=send, args=(chats[i::senders],)) for i in range(senders)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            total = len(chats) * per_chat
+            deadline = time.monotonic() + 60
+            while sum(len(ids) for ids in processed.values()) < total and time.monotonic() < deadline:
+                time.sleep(0.05)
+            elapsed = time.perf_counter() - started
+            server.shutdown()
+            samples = [(latency, self.queries.total / total) for latency, _ in samples]
+            self.report('webhook', samples, elapsed, self.sent_messages())
+            if statuses != Counter({200: total}):
+                raise RuntimeError(f"webhook: ответы {dict(statuses)} вместо {total} x 200")
+            for chat_id, updates in sent.items():
+                if processed[chat_id] != [update['update_id'] for update in updates]:
+                    raise RuntimeError(f"webhook: нарушен порядок апдейтов чата {chat_id}: {processed[chat_id]}")
+
+            # Один обработчик с очередью на один апдейт, остановленный на первом апдейте:
+            # второй занимает очередь, третий должен получить 503
+            gate.clear()
+            server = self.start_webhook(self.bot.UpdateWorkerPool(1, 1))
+            chat_id = chats[0]
+            results = [self.post_update(server, self.message(chat_id, "📊 Статус"))]
+            blocked.wait(10)
+            results += [self.post_update(server, self.message(chat_id, "📊 Статус")) for _ in range(2)]
+            gate.set()
+            server.shutdown()
+            if [status for status, _, _ in results] != [200, 200, 503] or results[2][1] is None:
+                raise RuntimeError(f"webhook: при переполненной очереди ответы {[status for status, _, _ in results]}, "
+                                   f"Retry-After {results[2][1]}")
+        finally:
+            gate.set()
+            del self.bot.bot.process_new_updates
+
+    def query_plan(self, function):
+        # План SQLite для последнего запроса, выполненного function
+        function()
+        statement, parameters = self.queries.last
+        with self.bot.engine.connect() as connection:
+            return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+    def plans(self):
+        # Постраничные списки должны начинать поиск по индексу имени с позиции курсора,
+        # а не сортировать всё соединение payments и users на каждой странице
+        if self.bot.engine.dialect.name != 'sqlite':
+            return
+        from sqlalchemy import func, select
+        with self.bot.session_scope() as session:
+            middle_id = session.scalar(select(func.max(self.bot.Payment.id))) // 2
+        key = self.bot.get_payment_browser_key(middle_id)
+        size = self.bot.PAYMENTS_PAGE_SIZE
+        checks = [(f"payments:{status}:{direction}",
+                   lambda status=status, direction=direction: self.bot.get_payments_page(
+                       status, 0, 0, direction, key if direction != 's' else None, size))
+                  for status in ('a', 'p') for direction in ('s', 'n', 'p')]
+        checks += [("user_totals:first", lambda: self.bot.get_user_totals_page(None, self.bot.STATS_PAGE_SIZE)),
+                   ("user_totals:next", lambda: self.bot.get_user_totals_page(key[:1] + (0,), self.bot.STATS_PAGE_SIZE))]
+        for name, function in checks:
+            plan = self.query_plan(function)
+            started = time.perf_counter()
+            function()
+            elapsed = (time.perf_counter() - started) * 1000
+            print(f"{name:<20} {elapsed:8.2f} мс  {' / '.join(plan)}")
+            if not any('INDEX ix_users_username_key (<expr>' in step for step in plan) \
+                    or any('TEMP B-TREE FOR ORDER BY' in step for step in plan):
+                raise RuntimeError(f"{name}: запрос страницы не использует поиск по ix_users_username_key")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Нагрузочные сценарии бота")
+    parser.add_argument('--database-url', default='sqlite:///bench.db')
+    parser.add_argument('--users', type=int, default=10000, help="пользователей при генерации новой базы")
+    parser.add_argument('--payments', type=int, default=200000, help="оплат при генерации новой базы")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--callbacks', type=int, default=500, help="пользователей в сценарии callbacks")
+    parser.add_argument('--admin-repeat', type=int, default=5)
+    parser.add_argument('--webhook', type=int, default=2000, help="апдейтов в сценарии webhook")
+    parser.add_argument('--send-rate', type=float, default=1000, help="глобальный лимит отправки бота, сообщ./с")
+    parser.add_argument('--chat-rate', type=float, default=1000, help="лимит отправки бота в один чат, сообщ./с")
+    parser.add_argument('--fail-403', type=float, default=0.0)
+    parser.add_argument('--fail-429', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа заглушки, секунды")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(fail_403=args.fail_403, fail_429=args.fail_429, latency=args.latency, seed=args.seed).start()
+    os.environ.update({
+        'BOT_TOKEN': '0:benchmark',
+        'ADMIN_ID': str(ADMIN_ID),
+        'DATABASE_URL': args.database_url,
+        'TELEGRAM_API_URL': server.api_url,
+        'SEND_RATE': str(args.send_rate),
+        'CHAT_SEND_RATE': str(args.chat_rate),
+        'REMINDER_WINDOW': '1',
+    })
+
+    database_path = args.database_url.split(':///', 1)[-1]
+    if args.database_url.startswith('sqlite') and not os.path.exists(database_path):
+        users = generate(args.database_url, args.users, args.payments, seed=args.seed)
+    else:
+        users = None
+
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.bot.threaded = False
+    # Рассылки и напоминания выполняет только ведущий экземпляр
+    bot.scheduler_lease.start()
+    while not bot.scheduler_lease.held:
+        time.sleep(0.05)
+    if users is None:
+        with bot.session_scope() as session:
+            users = [user_id for user_id, in session.query(bot.User.id).filter(bot.User.id >= FIRST_USER_ID)]
+
+    benchmark = Benchmark(bot, server, users, random.Random(args.seed))
+    for scenario in args.scenarios.split(','):
+        if scenario == 'callbacks':
+            benchmark.callbacks(args.callbacks)
+        elif scenario == 'admin':
+            benchmark.admin(args.admin_repeat)
+        elif scenario == 'broadcast':
+            benchmark.broadcast()
+        elif scenario == 'reminders':
+            benchmark.reminders()
+        elif scenario == 'webhook':
+            benchmark.webhook(args.webhook)
+        elif scenario == 'plans':
+            benchmark.plans()
+    server.stop()
+    os._exit(0)  # Фоновые потоки бота (пул TeleBot, рассылки) не завершаются сами
+
+
+if __name__ == '__main__':
+    main()
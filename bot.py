@@ -1,14 +1,42 @@
 import os
 from dotenv import load_dotenv
 import telebot
+from telebot import apihelper
 from telebot.apihelper import ApiTelegramException
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
+from telebot.util import extract_command
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, Update, CallbackQuery
 import datetime
 import time
 import threading
 import logging
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, func, Boolean
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+import queue
+import csv
+import json
+import io
+import tempfile
+import sys
+import traceback
+import functools
+import random
+import secrets
+import socket
+import itertools
+import multiprocessing
+import requests
+from requests.adapters import HTTPAdapter
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, Column, Integer, BigInteger, String, DateTime, ForeignKey, func, Boolean, Index, insert, select, update, delete, case, literal, literal_column, cast, inspect, text, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base, sessionmaker, relationship, aliased
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateIndex
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -21,136 +49,1223 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Адрес базы данных (любой URL SQLAlchemy, например postgresql://...) и Bot API
+# (например, локальный Bot API сервер или заглушка для нагрузочных тестов)
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///users.db')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # Формат apihelper.API_URL: http://host:port/bot{0}/{1}
+
+# Настройки массовой отправки сообщений
+SEND_RATE = float(os.getenv('SEND_RATE', '30'))  # Глобальный лимит Telegram ~30 сообщений в секунду
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '8'))
+SEND_MAX_ATTEMPTS = int(os.getenv('SEND_MAX_ATTEMPTS', '3'))
+CHAT_SEND_RATE = float(os.getenv('CHAT_SEND_RATE', '1'))  # Лимит Telegram ~1 сообщение в секунду в один чат
+CHAT_SEND_BURST = int(os.getenv('CHAT_SEND_BURST', '3'))
+
+# Защита от частых нажатий: апдейтов в секунду от одного пользователя, запас для серии нажатий
+# и окно, в котором повторное нажатие той же inline-кнопки отбрасывается
+FLOOD_RATE = float(os.getenv('FLOOD_RATE', '1'))
+FLOOD_BURST = int(os.getenv('FLOOD_BURST', '5'))
+CALLBACK_DEDUP_WINDOW = float(os.getenv('CALLBACK_DEDUP_WINDOW', '2'))  # секунды
+REMINDER_CHUNK_SIZE = int(os.getenv('REMINDER_CHUNK_SIZE', '1000'))
+# Отправленные напоминания записываются пачками такого размера: после сбоя повторно уйдут не больше стольких
+REMINDER_RECORD_BATCH = int(os.getenv('REMINDER_RECORD_BATCH', '20'))
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '100'))
+
+# Расписание напоминаний: дни месяца (первый - основное напоминание, остальные - повторные),
+# окно, на которое растягивается отправка, и период проверки расписания
+REMINDER_DAYS = sorted(int(day) for day in os.getenv('REMINDER_DAYS', '1').split(','))
+REMINDER_WINDOW = int(os.getenv('REMINDER_WINDOW', '3600'))  # секунды
+REMINDER_CHECK_INTERVAL = int(os.getenv('REMINDER_CHECK_INTERVAL', '300'))  # секунды
+
+# Настройки базы данных
+DB_BUSY_TIMEOUT = int(os.getenv('DB_BUSY_TIMEOUT', '5000'))  # мс
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+
+PAYMENTS_PAGE_SIZE = int(os.getenv('PAYMENTS_PAGE_SIZE', '10'))
+STATS_PAGE_SIZE = int(os.getenv('STATS_PAGE_SIZE', '50'))
+PAYMENT_INTENT_TTL = int(os.getenv('PAYMENT_INTENT_TTL', '86400'))  # секунды, сколько действует кнопка "Оплатил"
+
+# Хранилище состояний диалогов (ожидание комментария, текста рассылки): sql - таблица в базе бота,
+# memory - словарь в памяти процесса (для тестов)
+STATE_STORE = os.getenv('STATE_STORE', 'sql')
+CHAT_STATE_TTL = int(os.getenv('CHAT_STATE_TTL', '900'))  # секунды
+CHAT_STATE_MEMORY_SIZE = int(os.getenv('CHAT_STATE_MEMORY_SIZE', '10000'))
+MESSAGE_MAX_LENGTH = 4096  # Ограничение Telegram на длину сообщения
+
+# Режим получения апдейтов: polling или webhook
+RUN_MODE = os.getenv('RUN_MODE', 'polling')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес для setWebhook, без него вебхук не регистрируется
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '100'))  # на одного обработчика
+UPDATE_PROCESSES = int(os.getenv('UPDATE_PROCESSES', '1'))  # процессов обработки апдейтов в режиме вебхука
+
+# Несколько экземпляров бота с общей базой: ведущий экземпляр, владеющий арендой в таблице leases,
+# выполняет напоминания и рассылки. Если он пропадает, роль переходит другому через LEASE_TTL.
+INSTANCE_ID = os.getenv('INSTANCE_ID') or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TTL = int(os.getenv('LEASE_TTL', '30'))  # секунды
+LEASE_RENEW_INTERVAL = int(os.getenv('LEASE_RENEW_INTERVAL', '10'))  # секунды
+
+# Настройки кэша состояния подписок
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '10000'))
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', '600'))  # секунды
+# Сброс кэша передается только процессам своего экземпляра. Изменения, сделанные другими экземплярами,
+# обнаруживаются сверкой записи с версией строки subscriptions не чаще раза в столько секунд:
+# дольше этого другой экземпляр не покажет устаревший статус (0 - сверять при каждом обращении)
+SUBSCRIPTION_CACHE_VERIFY_INTERVAL = float(os.getenv('SUBSCRIPTION_CACHE_VERIFY_INTERVAL', '2'))
+
+# Клиент Bot API: пул keep-alive соединений, повторы с задержкой и автоматический выключатель
+API_POOL_SIZE = int(os.getenv('API_POOL_SIZE', '16'))
+API_BACKOFF_BASE = float(os.getenv('API_BACKOFF_BASE', '0.5'))  # секунды
+API_BACKOFF_MAX = float(os.getenv('API_BACKOFF_MAX', '10'))  # секунды
+API_MAX_RETRY_AFTER = int(os.getenv('API_MAX_RETRY_AFTER', '60'))  # дольше не ждем, сразу ошибка
+API_BREAKER_THRESHOLD = int(os.getenv('API_BREAKER_THRESHOLD', '5'))  # ошибок подряд до размыкания
+API_BREAKER_COOLDOWN = float(os.getenv('API_BREAKER_COOLDOWN', '30'))  # секунды
+
+# Метрики в формате Prometheus и профилировщик медленных апдейтов
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 - endpoint /metrics выключен
+SLOW_UPDATE_THRESHOLD = float(os.getenv('SLOW_UPDATE_THRESHOLD', '0'))  # секунды, 0 - профилировщик выключен
+SLOW_UPDATE_SAMPLE_INTERVAL = float(os.getenv('SLOW_UPDATE_SAMPLE_INTERVAL', '0.05'))  # секунды
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+class Metrics:
+    # Потокобезопасные счетчики, значения и гистограммы. Метки - кортеж пар (имя, значение).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}  # (имя, метки) -> (границы, количества по корзинам, [сумма])
+        self.collectors = []  # функции, возвращающие [(имя, метки, значение)] в момент запроса
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = (buckets, [0] * (len(buckets) + 1), [0])
+            histogram[1][bisect_left(histogram[0], value)] += 1
+            histogram[2][0] += value
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = dict(self.gauges)
+            histograms = sorted((key, (buckets, list(counts), total[0]))
+                                for key, (buckets, counts, total) in self.histograms.items())
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                gauges[(name, labels)] = value
+
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f"{name}{format_metric_labels(labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            declare(name, 'gauge')
+            lines.append(f"{name}{format_metric_labels(labels)} {value}")
+        for (name, labels), (buckets, counts, total) in histograms:
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_metric_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_metric_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+metrics = Metrics()
+
+class SlowUpdateProfiler:
+    # Пока апдейт обрабатывается дольше threshold, раз в interval снимается стек его потока.
+    # По завершении медленного апдейта в лог попадают самые частые стеки.
+    def __init__(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+        self.active = {}  # id потока -> (время начала, Counter стеков)
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, name='slow-update-profiler', daemon=True).start()
+
+    def start(self):
+        with self.lock:
+            self.active[threading.get_ident()] = (time.perf_counter(), Counter())
+
+    def finish(self, name, elapsed):
+        with self.lock:
+            entry = self.active.pop(threading.get_ident(), None)
+        if entry is None or elapsed < self.threshold:
+            return
+        samples = entry[1]
+        report = [f"Медленный апдейт {name}: {elapsed:.2f} с, снимков стека: {sum(samples.values())}"]
+        for stack, count in samples.most_common(3):
+            report.append(f"--- {count} раз:\n{stack}")
+        logger.warning('\n'.join(report))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self.lock:
+                slow = [thread_id for thread_id, (started, _) in self.active.items() if now - started >= self.threshold]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            stacks = {thread_id: ''.join(traceback.format_stack(frames[thread_id], limit=15))
+                      for thread_id in slow if thread_id in frames}
+            with self.lock:
+                for thread_id, stack in stacks.items():
+                    if thread_id in self.active:
+                        self.active[thread_id][1][stack] += 1
+
+slow_update_profiler = SlowUpdateProfiler(SLOW_UPDATE_THRESHOLD, SLOW_UPDATE_SAMPLE_INTERVAL) if SLOW_UPDATE_THRESHOLD > 0 else None
+
+def timed_handler(function):
+    # Гистограмма времени выполнения обработчика с меткой по имени функции
+    labels = (('handler', function.__name__),)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', time.perf_counter() - started, labels)
+    return wrapper
+
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
+
+bot = telebot.TeleBot(BOT_TOKEN, use_class_middlewares=True)
 
 # Настройка базы данных
 Base = declarative_base()
-engine = create_engine('sqlite:///users.db')
-Session = sessionmaker(bind=engine)
+database_url = make_url(DATABASE_URL)
+if database_url.get_backend_name() != 'sqlite':
+    engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True)
+elif database_url.database in (None, '', ':memory:'):
+    # База в памяти живет, пока открыто соединение: все потоки используют одно соединение (для тестов)
+    engine = create_engine(DATABASE_URL, connect_args={'check_same_thread': False}, poolclass=StaticPool)
+else:
+    engine = create_engine(DATABASE_URL,
+                           connect_args={'check_same_thread': False, 'timeout': DB_BUSY_TIMEOUT / 1000},
+                           pool_size=DB_POOL_SIZE,
+                           max_overflow=DB_MAX_OVERFLOW)
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL позволяет читать во время записи из другого потока, NORMAL безопасен в режиме WAL
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT}')
+    cursor.close()
+
+if engine.dialect.name == 'sqlite':
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+
+# Статистика текущего апдейта в потоке обработчика (см. MetricsMiddleware)
+_update_stats = threading.local()
+
+@event.listens_for(engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(engine, 'after_cursor_execute')
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    metrics.inc('bot_sql_queries_total')
+    metrics.inc('bot_sql_seconds_total', value=elapsed)
+    if getattr(_update_stats, 'started', None) is not None:
+        _update_stats.queries += 1
+        _update_stats.sql_time += elapsed
+
+# ID пользователей и чатов Telegram не помещаются в 32 бита. В SQLite INTEGER и так 64-битный,
+# а INTEGER PRIMARY KEY остается псевдонимом rowid, поэтому BIGINT нужен только остальным СУБД.
+TelegramId = BigInteger().with_variant(Integer, 'sqlite')
 
 class User(Base):
     __tablename__ = 'users'
-    id = Column(Integer, primary_key=True)
+    id = Column(TelegramId, primary_key=True)
     username = Column(String)
     payments = relationship("Payment", back_populates="user")
+    __table_args__ = (
+        Index('ix_users_username_key', func.coalesce(username, ''), id),
+    )
 
 class Payment(Base):
     __tablename__ = 'payments'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(TelegramId, ForeignKey('users.id'))
     payment_date = Column(DateTime, default=datetime.datetime.utcnow)
     amount = Column(Integer)
     confirmed = Column(Boolean, default=False)
     rejected = Column(Boolean, default=False)
     comment = Column(String)
     month = Column(String)
+    month_key = Column(Integer)  # year * 12 + month, см. month_to_key
     user = relationship("User", back_populates="payments")
+    __table_args__ = (
+        Index('ix_payments_user_month', 'user_id', 'month_key', 'confirmed', 'rejected'),
+        Index('ix_payments_confirmed_month', 'month_key', 'user_id',
+              sqlite_where=confirmed == True, postgresql_where=confirmed == True),
+        Index('ix_payments_confirmed_user_date', 'user_id', 'payment_date',
+              sqlite_where=confirmed == True, postgresql_where=confirmed == True),
+        Index('ix_payments_pending', 'payment_date',
+              sqlite_where=(confirmed == False) & (rejected == False),
+              postgresql_where=(confirmed == False) & (rejected == False)),
+    )
+
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+    id = Column(Integer, primary_key=True)
+    text = Column(String)
+    admin_chat_id = Column(TelegramId)
+    progress_message_id = Column(Integer)
+    status = Column(String, default='running')  # running / done
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    finished_at = Column(DateTime)
 
-# Создание таблиц
-Base.metadata.create_all(engine)
+class BroadcastRecipient(Base):
+    __tablename__ = 'broadcast_recipients'
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id'), primary_key=True)
+    user_id = Column(TelegramId, primary_key=True)
+    status = Column(String, default='pending')  # pending / sent / failed
+    __table_args__ = (Index('ix_broadcast_recipients_job_status', 'job_id', 'status', 'user_id'),)
 
-def add_user(user_id, username):
+class ReminderDelivery(Base):
+    # Журнал отправленных напоминаний: каждое (месяц, вид, пользователь) отправляется один раз
+    __tablename__ = 'reminder_deliveries'
+    month_key = Column(Integer, primary_key=True)
+    kind = Column(String, primary_key=True)
+    user_id = Column(TelegramId, primary_key=True)
+    sent_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class PaymentIntent(Base):
+    # Выбранный пользователем период до нажатия "Оплатил": в callback_data уходит только token
+    __tablename__ = 'payment_intents'
+    token = Column(String, primary_key=True)
+    user_id = Column(TelegramId, nullable=False)
+    amount = Column(Integer, nullable=False)
+    first_month_key = Column(Integer, nullable=False)
+    months_count = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (Index('ix_payment_intents_created', 'created_at'),)
+
+class ConversationState(Base):
+    # Текущий шаг диалога в чате: бот ждет от пользователя свободный текст
+    __tablename__ = 'conversation_states'
+    chat_id = Column(TelegramId, primary_key=True)
+    state = Column(String, nullable=False)
+    data = Column(String)  # JSON
+    expires_at = Column(DateTime, nullable=False)
+    __table_args__ = (Index('ix_conversation_states_expires', 'expires_at'),)
+
+class Subscription(Base):
+    # Сводка оплат пользователя, пересчитывается в той же транзакции, что и изменения payments
+    # (см. refresh_subscriptions). Строка есть у каждого пользователя.
+    __tablename__ = 'subscriptions'
+    user_id = Column(TelegramId, ForeignKey('users.id'), primary_key=True)
+    paid_through_month = Column(Integer, nullable=False, default=0)  # month_key последнего подтвержденного месяца, 0 - оплат нет
+    last_confirmed_at = Column(DateTime)
+    pending_count = Column(Integer, nullable=False, default=0)
+    version = Column(Integer, nullable=False, default=0)  # случайная метка, меняется при каждом пересчете строки
+    __table_args__ = (Index('ix_subscriptions_paid_through', 'paid_through_month', 'user_id'),)
+
+class Lease(Base):
+    # Аренда роли между экземплярами бота: holder владеет ролью, пока продлевает expires_at
+    __tablename__ = 'leases'
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+
+def month_to_key(month):
+    year, month = month.split('-')
+    return int(year) * 12 + int(month)
+
+def key_to_month(key):
+    return f"{(key - 1) // 12:04d}-{(key - 1) % 12 + 1:02d}"
+
+def migrate_payments_month_key(connection):
+    # Версия 1: целочисленный ключ месяца и составные/частичные индексы на payments
+    columns = [column['name'] for column in inspect(connection).get_columns('payments')]
+    if 'month_key' not in columns:
+        connection.execute(text('ALTER TABLE payments ADD COLUMN month_key INTEGER'))
+    payments = Payment.__table__
+    connection.execute(payments.update()
+                               .where(payments.c.month_key.is_(None), payments.c.month.isnot(None))
+                               .values(month_key=cast(func.substr(payments.c.month, 1, 4), Integer) * 12
+                                                 + cast(func.substr(payments.c.month, 6, 2), Integer)))
+    for index in payments.indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+def migrate_users_username_index(connection):
+    # Версия 2: индекс для постраничного просмотра оплат, упорядоченного по имени пользователя
+    for index in User.__table__.indexes:
+        connection.execute(CreateIndex(index, if_not_exists=True))
+
+def subscription_summary_query(user_ids=None):
+    # Сводка subscriptions, вычисленная по payments: (user_id, paid_through_month, last_confirmed_at, pending_count)
+    query = select(User.id,
+                   func.coalesce(func.max(case((Payment.confirmed == True, Payment.month_key))), 0),
+                   func.max(case((Payment.confirmed == True, Payment.payment_date))),
+                   func.count(case(((Payment.confirmed == False) & (Payment.rejected == False), Payment.id))))\
+            .select_from(User)\
+            .outerjoin(Payment, Payment.user_id == User.id)\
+            .group_by(User.id)
+    if user_ids is not None:
+        query = query.where(User.id.in_(user_ids))
+    return query
+
+# INSERT ... ON CONFLICT DO UPDATE для СУБД, которые его поддерживают
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+def rebuild_subscriptions(connection, user_ids=None):
+    # connection - Connection или Session; без user_ids пересчитывается вся таблица.
+    # Строки обновляются через upsert, а не удалением и вставкой: две транзакции, пересчитывающие
+    # одного пользователя (подтверждение оплаты и нажатие "Оплатил"), в PostgreSQL при READ COMMITTED
+    # иначе обе вставят строку и вторая упадет на первичном ключе.
+    columns = ['user_id', 'paid_through_month', 'last_confirmed_at', 'pending_count', 'version']
+    summary = subscription_summary_query(user_ids).add_columns(literal(random.getrandbits(31)))
+    upsert_insert = UPSERT_INSERTS.get(engine.dialect.name)
+    if upsert_insert is not None:
+        statement = upsert_insert(Subscription).from_select(columns, summary)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[Subscription.user_id],
+            set_={column: statement.excluded[column] for column in columns[1:]}
+        ))
+        return
+    statement = delete(Subscription)
+    if user_ids is not None:
+        statement = statement.where(Subscription.user_id.in_(user_ids))
+    connection.execute(statement)
+    connection.execute(insert(Subscription).from_select(columns, summary))
+
+def verify_subscriptions():
+    # ID пользователей, у которых сохраненная сводка расходится с пересчитанной по payments
+    stored = select(Subscription.user_id, Subscription.paid_through_month,
+                    Subscription.last_confirmed_at, Subscription.pending_count)
+    computed = subscription_summary_query()
+    with engine.connect() as connection:
+        mismatched = {row[0] for row in connection.execute(computed.except_(stored))}
+        mismatched.update(row[0] for row in connection.execute(stored.except_(computed)))
+    return sorted(mismatched)
+
+def migrate_subscriptions(connection):
+    # Версия 3: заполнение сводки subscriptions по существующим оплатам
+    rebuild_subscriptions(connection)
+
+def migrate_telegram_ids(connection):
+    # Версия 4: столбцы с ID пользователей и чатов Telegram расширяются до BIGINT.
+    # В SQLite тип столбца не ограничивает значение, менять нечего.
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in Base.metadata.sorted_tables:
+        for column in table.columns:
+            if column.type is TelegramId:
+                connection.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE BIGINT'))
+
+def migrate_subscriptions_version(connection):
+    # Версия 5: метка изменения строки сводки, по которой экземпляры сверяют кэш подписок
+    columns = [column['name'] for column in inspect(connection).get_columns('subscriptions')]
+    if 'version' not in columns:
+        connection.execute(text('ALTER TABLE subscriptions ADD COLUMN version INTEGER NOT NULL DEFAULT 0'))
+
+# Миграции применяются по порядку к существующей базе, номер версии хранится в schema_version
+MIGRATIONS = [
+    (1, migrate_payments_month_key),
+    (2, migrate_users_username_index),
+    (3, migrate_subscriptions),
+    (4, migrate_telegram_ids),
+    (5, migrate_subscriptions_version),
+]
+
+def migrate_db():
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        current = connection.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+        for version, migration in MIGRATIONS:
+            if version > current:
+                logger.info(f"Применение миграции базы данных до версии {version}")
+                migration(connection)
+                connection.execute(insert(SchemaVersion).values(version=version))
+
+# Создание таблиц и миграция существующей базы
+migrate_db()
+
+# Ключ сортировки пользователей по имени (имя может отсутствовать), покрыт индексом ix_users_username_key.
+# Пустая строка встраивается в SQL, а не передается параметром: иначе SQLite не сопоставит
+# выражение coalesce(users.username, ?) с выражением индекса.
+username_key = func.coalesce(User.username, literal_column("''"))
+
+def username_seek(condition):
+    # Условие на username_key, с которого постраничные запросы начинают поиск по ix_users_username_key.
+    # Без статистики (ANALYZE) SQLite оценивает его как малоизбирательное и при фильтре по статусу
+    # выбирает частичный индекс оплат с сортировкой всего результата; likelihood() подсказывает обратное.
+    if engine.dialect.name == 'sqlite':
+        return func.likelihood(condition, literal_column('0.01'))
+    return condition
+
+_unit_of_work = threading.local()
+
+@contextmanager
+def session_scope():
+    # Внутри обработки апдейта используется общая сессия (см. SessionMiddleware),
+    # её фиксирует middleware. Вне апдейта открывается собственная короткая транзакция.
+    session = getattr(_unit_of_work, 'session', None)
+    if session is not None:
+        yield session
+        return
     session = Session()
-    user = session.query(User).filter_by(id=user_id).first()
-    if not user:
-        user = User(id=user_id, username=username)
-        session.add(user)
-    else:
-        user.username = username
-    session.commit()
-    session.close()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def commit_unit_of_work():
+    # Фиксирует сделанное в общей сессии апдейта до обращения к Bot API: запрос может ждать
+    # лимитов и повторов, а открытая транзакция всё это время держит блокировку записи SQLite.
+    # Следующие запросы к базе в том же апдейте начинают новую транзакцию.
+    session = getattr(_unit_of_work, 'session', None)
+    if session is not None and session.in_transaction():
+        session.commit()
+
+ChatState = namedtuple('ChatState', ['name', 'data'])
+
+def dump_state_data(data):
+    return json.dumps(data, separators=(',', ':')) if data is not None else None
+
+def load_state_data(data):
+    return json.loads(data) if data is not None else None
+
+class MemoryStateStore:
+    # Состояния в памяти процесса: LRU не больше max_size чатов, просроченные удаляются при чтении
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # chat_id -> (истекает, имя, данные в JSON)
+        self.lock = threading.Lock()
+
+    def get(self, chat_id):
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[chat_id]
+                return None
+            return ChatState(entry[1], load_state_data(entry[2]))
+
+    def set(self, chat_id, name, data=None):
+        with self.lock:
+            self.entries[chat_id] = (time.monotonic() + self.ttl, name, dump_state_data(data))
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, chat_id):
+        with self.lock:
+            self.entries.pop(chat_id, None)
+
+    def purge_expired(self):
+        now = time.monotonic()
+        with self.lock:
+            for chat_id in [chat_id for chat_id, entry in self.entries.items() if entry[0] <= now]:
+                del self.entries[chat_id]
+
+class SQLStateStore:
+    # Состояния в таблице conversation_states: переживают перезапуск и видны всем процессам бота.
+    # Внутри апдейта изменения фиксируются вместе с остальной транзакцией обработчика.
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def get(self, chat_id):
+        with session_scope() as session:
+            row = session.query(ConversationState.state, ConversationState.data)\
+                         .filter(ConversationState.chat_id == chat_id,
+                                 ConversationState.expires_at > datetime.datetime.utcnow())\
+                         .first()
+        return ChatState(row.state, load_state_data(row.data)) if row else None
+
+    def set(self, chat_id, name, data=None):
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl)
+        with session_scope() as session:
+            session.merge(ConversationState(chat_id=chat_id, state=name, data=dump_state_data(data), expires_at=expires_at))
+
+    def delete(self, chat_id):
+        with session_scope() as session:
+            session.query(ConversationState).filter_by(chat_id=chat_id).delete(synchronize_session=False)
+
+    def purge_expired(self):
+        with session_scope() as session:
+            session.query(ConversationState)\
+                   .filter(ConversationState.expires_at <= datetime.datetime.utcnow())\
+                   .delete(synchronize_session=False)
+
+STATE_STORES = {
+    'sql': lambda: SQLStateStore(CHAT_STATE_TTL),
+    'memory': lambda: MemoryStateStore(CHAT_STATE_TTL, CHAT_STATE_MEMORY_SIZE),
+}
+chat_states = STATE_STORES[STATE_STORE]()
+
+Route = namedtuple('Route', ['handler', 'admin', 'denied'])
+ACCESS_DENIED = "У вас нет доступа к этой функции."
+
+class UpdateRouter:
+    # Тексты кнопок и команды ищутся в словаре, callback_data - по самому длинному
+    # зарегистрированному префиксу в боре, поэтому стоимость маршрутизации не зависит от числа обработчиков.
+    # Остальной текст передается обработчику состояния чата из chat_states, если оно есть.
+    def __init__(self):
+        self.texts = {}
+        self.commands = {}
+        self.states = {}
+        self.callbacks = {}  # узел бора: символ -> дочерний узел, маршрут узла лежит под ключом None
+
+    def text(self, text, admin=False, denied=None):
+        return self._register(self.texts, text, admin, denied)
+
+    def command(self, name, admin=False, denied=None):
+        return self._register(self.commands, name, admin, denied)
+
+    def state(self, name, admin=False, denied=None):
+        # Обработчик вызывается как handler(message, data) с данными, сохраненными вместе с состоянием
+        return self._register(self.states, name, admin, denied)
+
+    def callback(self, prefix, admin=False, denied=ACCESS_DENIED):
+        node = self.callbacks
+        for char in prefix:
+            node = node.setdefault(char, {})
+        return self._register(node, None, admin, denied)
+
+    def _register(self, routes, key, admin, denied):
+        def decorator(function):
+            routes[key] = Route(timed_handler(function), admin, denied)
+            return function
+        return decorator
+
+    def resolve_message(self, message):
+        # Возвращает (маршрут, состояние чата или None)
+        if message.content_type != 'text':
+            return None, None
+        command = extract_command(message.text)
+        if command is not None:
+            return self.commands.get(command.split('@')[0]), None
+        route = self.texts.get(message.text)
+        if route is not None:
+            return route, None
+        state = chat_states.get(message.chat.id)
+        if state is None:
+            return None, None
+        return self.states.get(state.name), state
+
+    def resolve_callback(self, data):
+        node, route = self.callbacks, None
+        for char in data or '':
+            node = node.get(char)
+            if node is None:
+                break
+            route = node.get(None, route)
+        return route
+
+router = UpdateRouter()
+
+# Ответ на отброшенное нажатие кнопки: на повтор ответит обработчик первого нажатия, поэтому без текста
+DROPPED_CALLBACK_ANSWERS = {'flood': "Слишком много нажатий, повторите через секунду.", 'duplicate': None}
+
+class FloodMiddleware(BaseMiddleware):
+    # Регистрируется первой: отброшенные апдейты не доходят до базы, обработчиков и метрик обработки
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, update, data):
+        reason = flood_guard.check(update)
+        if reason:
+            metrics.inc('bot_updates_dropped_total', (('reason', reason),))
+            if isinstance(update, CallbackQuery):
+                # Без ответа у кнопки крутится индикатор загрузки, пока Telegram не отменит запрос
+                try:
+                    bot.answer_callback_query(update.id, DROPPED_CALLBACK_ANSWERS[reason])
+                except ApiTelegramException as e:
+                    logger.debug(f"Не удалось ответить на отброшенное нажатие: {e}")
+            return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+class RouterMiddleware(BaseMiddleware):
+    # Выбирает обработчик и проверяет права администратора до открытия сессии и замера метрик.
+    # Апдейты без маршрута и запрещенные действия дальше не обрабатываются.
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, update, data):
+        is_callback = isinstance(update, CallbackQuery)
+        if is_callback:
+            route, state = router.resolve_callback(update.data), None
+        else:
+            route, state = router.resolve_message(update)
+        if route is None:
+            return CancelUpdate()
+        if route.admin and update.from_user.id != ADMIN_ID:
+            if route.denied and is_callback:
+                bot.answer_callback_query(update.id, route.denied)
+            elif route.denied:
+                bot.reply_to(update, route.denied)
+            return CancelUpdate()
+        data['route'] = route
+        data['chat_state'] = state
+
+    def post_process(self, update, data, exception):
+        pass
+
+class SessionMiddleware(BaseMiddleware):
+    # Одна сессия на входящий апдейт. Транзакция фиксируется перед каждым запросом к Bot API
+    # (см. commit_unit_of_work) и в конце обработки.
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, message, data):
+        _unit_of_work.session = Session()
+
+    def post_process(self, message, data, exception):
+        session = _unit_of_work.__dict__.pop('session', None)
+        if session is None:
+            return
+        try:
+            if exception is None:
+                session.commit()
+            else:
+                session.rollback()
+        finally:
+            session.close()
+
+class MetricsMiddleware(BaseMiddleware):
+    # Время обработки и SQL-запросы на апдейт. Регистрируется после SessionMiddleware,
+    # чтобы post_process учитывал и фиксацию транзакции.
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, message, data):
+        _update_stats.started = time.perf_counter()
+        _update_stats.queries = 0
+        _update_stats.sql_time = 0.0
+        if slow_update_profiler:
+            slow_update_profiler.start()
+
+    def post_process(self, message, data, exception):
+        started = _update_stats.__dict__.pop('started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        labels = (('type', 'callback_query' if isinstance(message, CallbackQuery) else 'message'),)
+        metrics.observe('bot_update_seconds', elapsed, labels)
+        metrics.observe('bot_update_sql_queries', _update_stats.queries, labels, buckets=QUERY_COUNT_BUCKETS)
+        metrics.observe('bot_update_sql_seconds', _update_stats.sql_time, labels)
+        if exception is not None:
+            metrics.inc('bot_update_errors_total', labels)
+        if slow_update_profiler:
+            slow_update_profiler.finish(f"{labels[0][1]} (ID: {message.from_user.id})", elapsed)
+
+bot.setup_middleware(FloodMiddleware())
+bot.setup_middleware(RouterMiddleware())
+bot.setup_middleware(SessionMiddleware())
+bot.setup_middleware(MetricsMiddleware())
+
+LastPayment = namedtuple('LastPayment', ['payment_date', 'month'])
+SubscriptionState = namedtuple('SubscriptionState', ['last_confirmed_month', 'confirmed_months', 'pending_months', 'last_payment',
+                                                     'version'], defaults=[None])
+
+class SubscriptionCache:
+    # Ограниченный LRU-кэш с TTL для состояния подписки пользователя. Запись старше verify_interval
+    # перед использованием сверяется с версией строки subscriptions (см. SUBSCRIPTION_CACHE_VERIFY_INTERVAL)
+    def __init__(self, max_size, ttl, verify_interval):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.verify_interval = verify_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id, loader, version_loader):
+        state, generation, verify = self.lookup(user_id)
+        if verify:
+            state = self.verified(user_id, state, version_loader(user_id))
+        if state is None:
+            state = loader(user_id)
+            self.store(user_id, state, generation)
+        return state
+
+    def lookup(self, user_id):
+        # (состояние или None, поколение кэша для store, нужна ли сверка версии) - для загрузчиков,
+        # которые нельзя вызвать из get. Если сверка нужна, результат передается в verified.
+        with self.lock:
+            entry = self.entries.get(user_id)
+            now = time.monotonic()
+            if entry and entry[0] > now:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1], self.generation, entry[2] <= now
+            self.misses += 1
+            return None, self.generation, False
+
+    def verified(self, user_id, state, version):
+        # Версия совпала - запись снова действительна verify_interval секунд и возвращается;
+        # иначе строку изменил другой экземпляр бота: запись удаляется, возвращается None
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if version == state.version:
+                if entry is not None and entry[1] is state:
+                    self.entries[user_id] = (entry[0], state, time.monotonic() + self.verify_interval)
+                return state
+            if entry is not None and entry[1] is state:
+                del self.entries[user_id]
+            self.hits -= 1
+            self.misses += 1
+            return None
+
+    def store(self, user_id, state, generation):
+        with self.lock:
+            # Если за время загрузки был сброс, загруженное значение могло устареть
+            if generation == self.generation:
+                now = time.monotonic()
+                self.entries[user_id] = (now + self.ttl, state, now + self.verify_interval)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+
+    def invalidate(self, user_ids):
+        with self.lock:
+            self.generation += 1
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+subscription_cache = SubscriptionCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_VERIFY_INTERVAL)
+
+def invalidate_subscriptions(session, user_ids):
+    # Кэш сбрасывается после фиксации транзакции, чтобы другие потоки не закэшировали старые данные
+    session.info.setdefault('invalidated_users', set()).update(user_ids)
+
+@event.listens_for(Session, 'before_commit')
+def refresh_subscriptions(session):
+    # Все функции, меняющие оплаты или пользователей, отмечают их через invalidate_subscriptions,
+    # поэтому сводка subscriptions пересчитывается здесь, в той же транзакции
+    user_ids = session.info.get('invalidated_users')
+    if user_ids:
+        rebuild_subscriptions(session, list(user_ids))
+
+# Очередь, через которую сброс кэша передается остальным процессам обработки апдейтов (см. UpdateProcessPool)
+cache_invalidation_queue = None
+
+@event.listens_for(Session, 'after_commit')
+def flush_subscription_invalidations(session):
+    user_ids = session.info.pop('invalidated_users', None)
+    if user_ids:
+        subscription_cache.invalidate(user_ids)
+        if cache_invalidation_queue is not None:
+            cache_invalidation_queue.put((os.getpid(), list(user_ids)))
+
+@event.listens_for(Session, 'after_rollback')
+def discard_subscription_invalidations(session):
+    session.info.pop('invalidated_users', None)
+
+def subscription_payments_query(user_id):
+    return select(Payment.month_key, Payment.confirmed, Payment.payment_date)\
+           .where(Payment.user_id == user_id, (Payment.confirmed == True) | (Payment.rejected == False))
+
+def subscription_version_query(user_id):
+    return select(Subscription.version).where(Subscription.user_id == user_id)
+
+def load_subscription_state(user_id):
+    with session_scope() as session:
+        # Версия читается до оплат: изменение, зафиксированное между запросами, при сверке даст новую версию
+        version = session.scalar(subscription_version_query(user_id))
+        payments = session.execute(subscription_payments_query(user_id)).all()
+    return build_subscription_state(payments, version)
+
+def load_subscription_version(user_id):
+    with session_scope() as session:
+        return session.scalar(subscription_version_query(user_id))
+
+def build_subscription_state(payments, version=None):
+    confirmed_months = frozenset(p.month_key for p in payments if p.confirmed)
+    pending_months = frozenset(p.month_key for p in payments if not p.confirmed)
+    # Оплата за несколько месяцев - это строки с одной датой, из них последней считается поздний месяц
+    last_confirmed = max((p for p in payments if p.confirmed), key=lambda p: (p.payment_date, p.month_key), default=None)
+    return SubscriptionState(
+        last_confirmed_month=max(confirmed_months, default=None),
+        confirmed_months=confirmed_months,
+        pending_months=pending_months,
+        last_payment=LastPayment(last_confirmed.payment_date, key_to_month(last_confirmed.month_key)) if last_confirmed else None,
+        version=version,
+    )
+
+def get_subscription_state(user_id):
+    return subscription_cache.get(user_id, load_subscription_state, load_subscription_version)
+
+def add_user(user_id, username):
+    with session_scope() as session:
+        user = session.query(User).filter_by(id=user_id).first()
+        if not user:
+            user = User(id=user_id, username=username)
+            session.add(user)
+            invalidate_subscriptions(session, [user_id])  # создаст строку в subscriptions
+        else:
+            user.username = username
 
 def get_all_users():
-    session = Session()
-    users = session.query(User).all()
-    session.close()
-    return [(user.id, user.username) for user in users]
+    with session_scope() as session:
+        return [(user.id, user.username) for user in session.query(User.id, User.username)]
 
 def remove_user(user_id):
-    session = Session()
-    user = session.query(User).filter_by(id=user_id).first()
-    if user:
-        session.delete(user)
-        session.commit()
-    session.close()
+    remove_users([user_id])
+
+def remove_users(user_ids):
+    # Массовое удаление одним запросом (например, пользователей, заблокировавших бота)
+    if not user_ids:
+        return 0
+    with session_scope() as session:
+        invalidate_subscriptions(session, user_ids)
+        session.query(Payment).filter(Payment.user_id.in_(user_ids)).update({Payment.user_id: None}, synchronize_session=False)
+        # Строки сводки ссылаются на users: удаляются до пользователей, иначе СУБД с проверкой
+        # внешних ключей отклонит удаление. Пересчет при фиксации их уже не создаст.
+        session.query(Subscription).filter(Subscription.user_id.in_(user_ids)).delete(synchronize_session=False)
+        return session.query(User).filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+
+def unpaid_users_query(session, month, not_reminded=None, reminded=None):
+    # Пользователи, у которых подписка оплачена раньше месяца (сводка subscriptions).
+    # not_reminded - исключить получивших напоминание этого вида за месяц,
+    # reminded - брать кандидатов из журнала напоминаний этого вида вместо всей таблицы users.
+    # Возвращает запрос (id, username) и столбец id для сортировки.
+    month_key = month_to_key(month)
+    if reminded:
+        candidates = session.query(ReminderDelivery.user_id.label('id'), User.username)\
+                            .join(User, User.id == ReminderDelivery.user_id)\
+                            .join(Subscription, Subscription.user_id == ReminderDelivery.user_id)\
+                            .filter(ReminderDelivery.month_key == month_key, ReminderDelivery.kind == reminded)
+        candidate_id = ReminderDelivery.user_id
+    else:
+        candidates = session.query(Subscription.user_id.label('id'), User.username)\
+                            .join(User, User.id == Subscription.user_id)
+        candidate_id = Subscription.user_id
+    query = candidates.filter(Subscription.paid_through_month < month_key)
+    if not_reminded:
+        delivered = session.query(ReminderDelivery.user_id)\
+                           .filter(ReminderDelivery.month_key == month_key,
+                                   ReminderDelivery.kind == not_reminded,
+                                   ReminderDelivery.user_id == candidate_id)\
+                           .exists()
+        query = query.filter(~delivered)
+    return query, candidate_id
+
+def iter_unpaid_users(month, chunk_size=REMINDER_CHUNK_SIZE, not_reminded=None, reminded=None):
+    # Порции выбираются по возрастанию id, чтобы не держать открытую транзакцию всё время рассылки
+    last_id = None
+    while True:
+        with session_scope() as session:
+            query, candidate_id = unpaid_users_query(session, month, not_reminded, reminded)
+            if last_id is not None:
+                query = query.filter(candidate_id > last_id)
+            rows = query.order_by(candidate_id).limit(chunk_size).all()
+        if not rows:
+            return
+        for row in rows:
+            yield row.id, row.username
+        last_id = rows[-1].id
+
+def count_unpaid_users(month, not_reminded=None, reminded=None):
+    with session_scope() as session:
+        query, _ = unpaid_users_query(session, month, not_reminded, reminded)
+        return query.count()
+
+def record_reminder_deliveries(month, kind, user_ids):
+    if not user_ids:
+        return
+    month_key = month_to_key(month)
+    with session_scope() as session:
+        session.execute(insert(ReminderDelivery),
+                        [{'month_key': month_key, 'kind': kind, 'user_id': user_id} for user_id in user_ids])
 
 def add_payment(user_id, total_amount, months):
-    session = Session()
-    payments = []
+    with session_scope() as session:
+        return insert_payments(session, user_id, total_amount, months)
+
+def insert_payments(session, user_id, total_amount, months):
     amount_per_month = total_amount // len(months)
-    for month in months:
-        payment = Payment(user_id=user_id, amount=amount_per_month, confirmed=False, month=month)
-        session.add(payment)
-        payments.append(payment)
-    session.commit()
-    payment_ids = [payment.id for payment in payments]
-    session.close()
-    return payment_ids
+    # Общая дата у всех месяцев одной оплаты: по ней платежи группируются при подтверждении
+    payment_date = datetime.datetime.utcnow()
+    payments = [dict(user_id=user_id, amount=amount_per_month, confirmed=False, rejected=False, month=month,
+                     month_key=month_to_key(month), payment_date=payment_date)
+                for month in months]
+    invalidate_subscriptions(session, [user_id])
+    # Один INSERT на все месяцы вместо отдельного запроса на каждую строку
+    return list(session.scalars(insert(Payment).returning(Payment.id), payments))
+
+def lock_subscription_query(user_id):
+    # Блокирует строку сводки пользователя до конца транзакции (в PostgreSQL): параллельные оплаты
+    # одного пользователя проверяются по базе по очереди. В SQLite писатель и так один.
+    return select(Subscription.user_id).where(Subscription.user_id == user_id).with_for_update()
+
+def paid_month_keys_query(user_id, months):
+    # Месяцы из списка, за которые в базе есть подтвержденная или ожидающая проверки оплата
+    return select(Payment.month_key).where(Payment.user_id == user_id,
+                                           Payment.month_key.in_([month_to_key(month) for month in months]),
+                                           (Payment.confirmed == True) | (Payment.rejected == False))
+
+def add_new_payment(user_id, total_amount, months):
+    # Платеж создается, только если за эти месяцы еще нет оплаты; возвращает уже оплаченные месяцы.
+    # Проверка идет по базе в транзакции вставки, а не по кэшу подписки: сброс кэша после оплаты
+    # через другой экземпляр бота доходит до этого процесса не сразу.
+    with session_scope() as session:
+        session.execute(lock_subscription_query(user_id))
+        paid_keys = set(session.scalars(paid_month_keys_query(user_id, months)))
+        already_paid_months = [month for month in months if month_to_key(month) in paid_keys]
+        if not already_paid_months:
+            insert_payments(session, user_id, total_amount, months)
+    return already_paid_months
+
+def create_payment_intent(user_id, amount, months):
+    # Месяцы идут подряд, поэтому хранится первый месяц и их количество
+    token = secrets.token_urlsafe(8)
+    with session_scope() as session:
+        session.add(PaymentIntent(token=token, user_id=user_id, amount=amount,
+                                  first_month_key=month_to_key(months[0]), months_count=len(months)))
+    return token
+
+def take_payment_intent(token, user_id):
+    # Поиск и удаление одним запросом: повторное нажатие "Оплатил" не создаст второй платеж.
+    # Возвращает (сумма, месяцы) или None, если намерение чужое, устарело или уже использовано.
+    created_after = datetime.datetime.utcnow() - datetime.timedelta(seconds=PAYMENT_INTENT_TTL)
+    with session_scope() as session:
+        intent = session.execute(delete(PaymentIntent)
+                                 .where(PaymentIntent.token == token,
+                                        PaymentIntent.user_id == user_id,
+                                        PaymentIntent.created_at >= created_after)
+                                 .returning(PaymentIntent.amount, PaymentIntent.first_month_key, PaymentIntent.months_count)).first()
+    if intent is None:
+        return None
+    first_key = intent.first_month_key
+    return intent.amount, [key_to_month(key) for key in range(first_key, first_key + intent.months_count)]
+
+def purge_expired_payment_intents():
+    created_after = datetime.datetime.utcnow() - datetime.timedelta(seconds=PAYMENT_INTENT_TTL)
+    with session_scope() as session:
+        session.execute(delete(PaymentIntent).where(PaymentIntent.created_at < created_after))
 
 def confirm_payment(payment_id):
-    session = Session()
-    payment = session.query(Payment).filter_by(id=payment_id).first()
-    if payment:
-        payment.confirmed = True
-        session.commit()
-    session.close()
+    confirm_payments([payment_id])
+
+def get_payment_user_ids(session, payment_ids):
+    return [user_id for user_id, in session.query(Payment.user_id).filter(Payment.id.in_(payment_ids)).distinct()]
+
+def get_payment_group_ids(payment_ids):
+    # Оплата за несколько месяцев - это строки пользователя с общей payment_date (см. add_payment).
+    # Подтверждение и отклонение из списка оплат действуют на все ее ожидающие месяцы, а не на один.
+    selected = aliased(Payment)
+    with session_scope() as session:
+        group_ids = session.query(Payment.id)\
+                           .join(selected, (selected.user_id == Payment.user_id) & (selected.payment_date == Payment.payment_date))\
+                           .filter(selected.id.in_(payment_ids), Payment.confirmed == False, Payment.rejected == False)
+        return sorted(set(payment_ids) | {payment_id for payment_id, in group_ids})
+
+def confirm_payments(payment_ids):
+    with session_scope() as session:
+        invalidate_subscriptions(session, get_payment_user_ids(session, payment_ids))
+        return session.query(Payment)\
+                      .filter(Payment.id.in_(payment_ids))\
+                      .update({Payment.confirmed: True}, synchronize_session=False)
+
+def confirm_pending_payments(month_key=None, payment_ids=None):
+    # Подтверждает ожидающие оплаты (все, за месяц или выбранные) одним UPDATE.
+    # Возвращает {user_id: [месяцы]} для уведомления пользователей.
+    statement = update(Payment).where(Payment.confirmed == False, Payment.rejected == False)
+    if month_key:
+        statement = statement.where(Payment.month_key == month_key)
+    if payment_ids is not None:
+        statement = statement.where(Payment.id.in_(payment_ids))
+    statement = statement.values(confirmed=True)\
+                         .returning(Payment.user_id, Payment.month)\
+                         .execution_options(synchronize_session=False)
+    confirmed = {}
+    with session_scope() as session:
+        for user_id, month in session.execute(statement):
+            confirmed.setdefault(user_id, []).append(month)
+        invalidate_subscriptions(session, confirmed.keys())
+    return confirmed
+
+def get_pending_months():
+    with session_scope() as session:
+        return session.query(Payment.month_key, func.count('*'))\
+                      .filter(Payment.confirmed == False, Payment.rejected == False)\
+                      .group_by(Payment.month_key)\
+                      .order_by(Payment.month_key)\
+                      .all()
+
+def count_pending_payments(month_key=None):
+    with session_scope() as session:
+        query = session.query(func.count(Payment.id)).filter(Payment.confirmed == False, Payment.rejected == False)
+        if month_key:
+            query = query.filter(Payment.month_key == month_key)
+        return query.scalar()
 
 def reject_payment(payment_id, comment):
-    session = Session()
-    payment = session.query(Payment).filter_by(id=payment_id).first()
-    if payment:
-        payment.rejected = True
-        payment.comment = comment
-        session.commit()
-        user_id = payment.user_id
-    session.close()
-    return user_id if payment else None
+    user_ids = reject_payments([payment_id], comment)
+    return user_ids[0] if user_ids else None
+
+def reject_payments(payment_ids, comment):
+    # Возвращает ID пользователей отклоненных платежей (пустой список, если платежи не найдены)
+    with session_scope() as session:
+        user_ids = get_payment_user_ids(session, payment_ids)
+        if not user_ids:
+            return []
+        invalidate_subscriptions(session, user_ids)
+        session.query(Payment)\
+               .filter(Payment.id.in_(payment_ids))\
+               .update({Payment.rejected: True, Payment.comment: comment}, synchronize_session=False)
+        return user_ids
+
+def payments_by_month_query(session):
+    return session.query(User.username, 
+                         Payment.month_key,
+                         func.count('*').label('count'),
+                         func.sum(Payment.amount).label('amount'))\
+                  .join(Payment)\
+                  .filter(Payment.confirmed == True)\
+                  .group_by(User.id, User.username, Payment.month_key)
 
 def get_payments_by_month():
-    session = Session()
-    payments = session.query(User.username, 
-                             Payment.month,
-                             func.count('*').label('count'))\
-                      .join(Payment)\
-                      .filter(Payment.confirmed == True)\
-                      .group_by(User.id, Payment.month)\
-                      .order_by(Payment.month.desc(), User.username)\
-                      .all()
-    session.close()
-    return [(p.username, p.month, p.count) for p in payments]
+    with session_scope() as session:
+        payments = payments_by_month_query(session)\
+                          .order_by(Payment.month_key.desc(), User.username)\
+                          .all()
+    return [(p.username, key_to_month(p.month_key), p.count) for p in payments]
+
+def get_revenue_by_month():
+    # Помесячные итоги поверх группировки get_payments_by_month: (месяц, пользователей, оплат, сумма)
+    with session_scope() as session:
+        grouped = payments_by_month_query(session).subquery()
+        months = session.query(grouped.c.month_key,
+                               func.count('*'),
+                               func.sum(grouped.c.count),
+                               func.sum(grouped.c.amount))\
+                        .group_by(grouped.c.month_key)\
+                        .order_by(grouped.c.month_key.desc())\
+                        .all()
+    return [(key_to_month(month_key), users, count, amount) for month_key, users, count, amount in months]
+
+def get_user_totals_page(after_key, limit):
+    # Итоги подтвержденных оплат по пользователям, страница после ключа (username, id)
+    with session_scope() as session:
+        query = session.query(User.id, User.username, username_key.label('sort_name'),
+                              func.count(Payment.id), func.sum(Payment.amount))\
+                       .join(Payment)\
+                       .filter(Payment.confirmed == True)
+        # Поиск по ix_users_username_key с позиции курсора, как в get_payments_page; группировка
+        # в порядке сортировки, чтобы SQLite не сортировал все группы перед LIMIT
+        if after_key:
+            query = query.filter(username_seek(username_key >= after_key[0]),
+                                 tuple_(username_key, User.id) > tuple_(*after_key))
+        else:
+            query = query.filter(username_seek(username_key >= ''))
+        return query.group_by(username_key, User.id)\
+                    .order_by(username_key, User.id)\
+                    .limit(limit + 1)\
+                    .all()
+
+def write_payments_csv(fileobj):
+    # Все подтвержденные оплаты читаются порциями, память не зависит от размера таблицы
+    writer = csv.writer(fileobj)
+    writer.writerow(['payment_id', 'user_id', 'username', 'month', 'amount', 'payment_date'])
+    with session_scope() as session:
+        rows = session.execute(select(Payment.id, User.id, User.username, Payment.month, Payment.amount, Payment.payment_date)
+                               .join(User)
+                               .where(Payment.confirmed == True)
+                               .order_by(User.id, Payment.month_key)
+                               .execution_options(yield_per=1000))
+        for row in rows:
+            writer.writerow(row)
 
 def get_last_payment(user_id):
-    session = Session()
-    last_payment = session.query(Payment)\
-                          .filter_by(user_id=user_id, confirmed=True)\
-                          .order_by(Payment.payment_date.desc())\
-                          .first()
-    session.close()
-    return last_payment
+    return get_subscription_state(user_id).last_payment
 
 def is_payment_confirmed_for_month(user_id, month):
-    session = Session()
-    payment = session.query(Payment)\
-                     .filter_by(user_id=user_id, month=month, confirmed=True)\
-                     .first()
-    session.close()
-    return payment is not None
+    return month_to_key(month) in get_subscription_state(user_id).confirmed_months
+
+def get_existing_payment_months(user_id, months):
+    return filter_existing_payment_months(get_subscription_state(user_id), months)
+
+def filter_existing_payment_months(state, months):
+    # Месяцы из списка, за которые уже есть подтвержденная или ожидающая проверки оплата
+    return [month for month in months
+            if month_to_key(month) in state.confirmed_months or month_to_key(month) in state.pending_months]
 
 def is_payment_exists_for_month(user_id, month):
-    session = Session()
-    payment = session.query(Payment)\
-                     .filter_by(user_id=user_id, month=month)\
-                     .filter((Payment.confirmed == True) | ((Payment.confirmed == False) & (Payment.rejected == False)))\
-                     .first()
-    session.close()
-    return payment is not None
+    return bool(get_existing_payment_months(user_id, [month]))
 
+# Клавиатуры не меняются, поэтому строятся один раз
+@functools.lru_cache(maxsize=None)
 def get_user_keyboard():
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.add(KeyboardButton("📊 Статус"), KeyboardButton("💰 Оплатить"))
     keyboard.add(KeyboardButton("👨‍💼 Админ-панель"))
     return keyboard
 
+@functools.lru_cache(maxsize=None)
 def get_admin_keyboard():
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.add(KeyboardButton("👥 Список пользователей"), KeyboardButton("📈 Статистика оплат"))
@@ -160,68 +1275,385 @@ def get_admin_keyboard():
     return keyboard
 
 def get_last_paid_month(user_id):
-    session = Session()
-    last_payment = session.query(Payment)\
-                          .filter_by(user_id=user_id, confirmed=True)\
-                          .order_by(Payment.month.desc())\
-                          .first()
-    session.close()
-    if last_payment:
-        return datetime.datetime.strptime(last_payment.month, '%Y-%m')
+    month_key = get_subscription_state(user_id).last_confirmed_month
+    if month_key:
+        return datetime.datetime.strptime(key_to_month(month_key), '%Y-%m')
     return None
 
 def delete_payment(payment_id):
-    session = Session()
-    payment = session.query(Payment).filter_by(id=payment_id).first()
-    if payment:
-        session.delete(payment)
-        session.commit()
-    session.close()
+    with session_scope() as session:
+        invalidate_subscriptions(session, get_payment_user_ids(session, [payment_id]))
+        session.query(Payment).filter_by(id=payment_id).delete(synchronize_session=False)
+
+class TokenBucket:
+    # Потокобезопасный token bucket: rate токенов в секунду, не больше capacity накопленных
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def reserve(self):
+        # Берет токен в долг и возвращает, сколько секунд подождать до его появления (для asyncio)
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds):
+        # После 429 все отправители ждут retry_after: уводим баланс в минус.
+        # Одновременные 429 от нескольких потоков не суммируют паузу.
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+send_bucket = TokenBucket(SEND_RATE)
+
+class ChatRateLimiter:
+    # Token bucket на каждый чат; записи чатов, накопивших полный запас, периодически удаляются
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # chat_id -> (токены, время обновления)
+        self.lock = threading.Lock()
+        self.next_cleanup = time.monotonic()
+
+    def acquire(self, chat_id):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.next_cleanup:
+                    self.cleanup(now)
+                tokens, updated = self.buckets.get(chat_id, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self.buckets[chat_id] = (tokens - 1, now)
+                    return
+                self.buckets[chat_id] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self, chat_id):
+        # Без ожидания: False, если запас чата исчерпан
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.next_cleanup:
+                self.cleanup(now)
+            tokens, updated = self.buckets.get(chat_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets[chat_id] = (tokens, now)
+                return False
+            self.buckets[chat_id] = (tokens - 1, now)
+            return True
+
+    def reserve(self, chat_id):
+        # Как TokenBucket.reserve: токен берется в долг, возвращается время ожидания
+        with self.lock:
+            now = time.monotonic()
+            if now >= self.next_cleanup:
+                self.cleanup(now)
+            tokens, updated = self.buckets.get(chat_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+            self.buckets[chat_id] = (tokens, now)
+            return max(0.0, -tokens / self.rate)
+
+    def cleanup(self, now):
+        full = self.burst / self.rate
+        for chat_id in [chat_id for chat_id, (_, updated) in self.buckets.items() if now - updated >= full]:
+            del self.buckets[chat_id]
+        self.next_cleanup = now + full
+
+chat_limiter = ChatRateLimiter(CHAT_SEND_RATE, CHAT_SEND_BURST)
+
+class FloodGuard:
+    # Входящие апдейты пользователя: не больше rate в секунду с запасом burst, а повторное нажатие
+    # той же inline-кнопки в течение window секунд отбрасывается - обработчик ответит на первое.
+    # Администратор не ограничивается: выбор оплат в списке - это частые нажатия одних и тех же кнопок.
+    def __init__(self, rate, burst, window):
+        self.limiter = ChatRateLimiter(rate, burst)
+        self.window = window
+        self.callbacks = OrderedDict()  # (user_id, callback_data) -> истекает; порядок вставки совпадает с порядком истечения
+        self.lock = threading.Lock()
+
+    def check(self, update):
+        # Причина, по которой апдейт отбрасывается ('duplicate' или 'flood'), или None
+        user_id = update.from_user.id
+        if user_id == ADMIN_ID:
+            return None
+        if isinstance(update, CallbackQuery) and self.is_duplicate(user_id, update.data):
+            return 'duplicate'
+        if not self.limiter.try_acquire(user_id):
+            return 'flood'
+        return None
+
+    def is_duplicate(self, user_id, data):
+        now = time.monotonic()
+        key = (user_id, data)
+        with self.lock:
+            while self.callbacks and next(iter(self.callbacks.values())) <= now:
+                self.callbacks.popitem(last=False)
+            if key in self.callbacks:
+                return True
+            self.callbacks[key] = now + self.window
+            return False
+
+flood_guard = FloodGuard(FLOOD_RATE, FLOOD_BURST, CALLBACK_DEDUP_WINDOW)
 
-@bot.message_handler(commands=['start'])
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+class CircuitBreaker:
+    # После threshold сетевых ошибок или 5xx подряд запросы сразу отклоняются на cooldown секунд,
+    # затем один пробный запрос решает, замкнуть цепь или снова разомкнуть
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_until = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.failures < self.threshold:
+                return
+            if self.probing or time.monotonic() < self.opened_until:
+                raise CircuitOpenError("Bot API недоступен, запрос отклонен выключателем")
+            self.probing = True
+
+    def record(self, ok):
+        with self.lock:
+            self.probing = False
+            if ok:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_until <= time.monotonic():
+                    logger.warning(f"Bot API недоступен, запросы приостановлены на {self.cooldown:.0f} с")
+                self.opened_until = time.monotonic() + self.cooldown
+
+api_breaker = CircuitBreaker(API_BREAKER_THRESHOLD, API_BREAKER_COOLDOWN)
+
+# Одна сессия на процесс: соединения с Bot API переиспользуются между потоками
+api_session = requests.Session()
+api_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE, pool_block=True)
+api_session.mount('https://', api_adapter)
+api_session.mount('http://', api_adapter)
+
+# Методы, на которые действуют лимиты Telegram на отправку сообщений
+RATE_LIMITED_METHODS = {'sendMessage', 'sendDocument', 'editMessageText', 'editMessageReplyMarkup'}
+
+def get_retry_after(response):
+    try:
+        parameters = response.json().get('parameters') or {}
+    except ValueError:
+        parameters = {}
+    return parameters.get('retry_after', 1)
+
+def get_backoff(attempt):
+    # Экспоненциальная задержка с полным джиттером, чтобы потоки не повторяли запросы одновременно
+    return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt))
+
+def get_file_positions(files):
+    # Позиции потоков в файлах запроса: перед повтором они перематываются, иначе повтор отправит
+    # уже прочитанный (пустой) поток. None, если какой-то поток перемотать нельзя.
+    positions = []
+    for value in (files or {}).values():
+        stream = value[1] if isinstance(value, tuple) else value
+        if isinstance(stream, (bytes, str)):
+            continue
+        if not (hasattr(stream, 'seekable') and stream.seekable()):
+            return None
+        positions.append((stream, stream.tell()))
+    return positions
+
+def send_api_request(method, url, **kwargs):
+    # Все запросы к Bot API проходят здесь: общий и поканальный лимиты, повторы после 429,
+    # сетевых ошибок и 5xx, выключатель и метрики по методу и HTTP-статусу.
+    # Ответ с ошибкой возвращается как есть, исключение из него делает telebot.
+    api_method = url.rsplit('/', 1)[-1]
+    chat_id = (kwargs.get('params') or {}).get('chat_id')
+    limited = api_method in RATE_LIMITED_METHODS
+    commit_unit_of_work()
+    # Ответы из обработчика апдейта не ждут лимита чата: поток обработчика не блокируется,
+    # а редкое превышение лимита одним чатом обрабатывается повтором после 429 с retry_after.
+    # Фоновые отправки (рассылки, напоминания, уведомления администратору) соблюдают его заранее.
+    chat_limited = limited and chat_id is not None and getattr(_unit_of_work, 'session', None) is None
+    file_positions = get_file_positions(kwargs.get('files'))
+    for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+        if attempt > 1:
+            for stream, position in file_positions:
+                stream.seek(position)
+        api_breaker.before_request()
+        if limited:
+            send_bucket.acquire()
+            if chat_limited:
+                chat_limiter.acquire(chat_id)
+        started = time.perf_counter()
+        try:
+            response = api_session.request(method, url, **kwargs)
+        except requests.exceptions.ConnectionError:
+            # Таймаут чтения не повторяем: сообщение могло уже уйти
+            api_breaker.record(False)
+            metrics.inc('bot_api_requests_total', (('method', api_method), ('status', 'error')))
+            if attempt == SEND_MAX_ATTEMPTS or file_positions is None:
+                raise
+            time.sleep(get_backoff(attempt))
+            continue
+        except Exception:
+            api_breaker.record(False)
+            metrics.inc('bot_api_requests_total', (('method', api_method), ('status', 'error')))
+            raise
+        metrics.inc('bot_api_requests_total', (('method', api_method), ('status', response.status_code)))
+        metrics.observe('bot_api_request_seconds', time.perf_counter() - started, (('method', api_method),))
+        api_breaker.record(response.status_code < 500)
+        if attempt == SEND_MAX_ATTEMPTS or file_positions is None:
+            return response
+        if response.status_code == 429:
+            retry_after = get_retry_after(response)
+            if retry_after > API_MAX_RETRY_AFTER:
+                return response
+            metrics.inc('bot_send_retries_total')
+            logger.warning(f"Превышен лимит Telegram, пауза {retry_after} с")
+            if limited:
+                # Остальные отправители тоже ждут retry_after, иначе получат тот же ответ;
+                # сама пауза выдерживается при следующем send_bucket.acquire()
+                send_bucket.pause(retry_after)
+                time.sleep(get_backoff(0))
+            else:
+                time.sleep(retry_after + get_backoff(0))
+        elif response.status_code >= 500:
+            metrics.inc('bot_send_retries_total')
+            time.sleep(get_backoff(attempt))
+        else:
+            return response
+
+apihelper.CUSTOM_REQUEST_SENDER = send_api_request
+
+def dispatch_messages(messages, workers=SEND_WORKERS, on_result=None, pacer=None, name='notifications'):
+    # Конкурентная отправка (chat_id, message_text, reply_markup) с общим лимитом скорости.
+    # Сообщения читаются из итератора по мере отправки, в работе не больше 2*workers задач.
+    # on_result(chat_id, ok) вызывается из рабочих потоков после каждой попытки,
+    # pacer - дополнительный TokenBucket, если отправку нужно растянуть во времени,
+    # name - метка очереди в метриках bot_messages_total.
+    result = {'sent': 0, 'failed': 0, 'blocked': []}
+    lock = threading.Lock()
+    slots = threading.Semaphore(workers * 2)
+
+    def send(chat_id, message_text, reply_markup):
+        try:
+            bot.send_message(chat_id, message_text, reply_markup=reply_markup)
+            with lock:
+                result['sent'] += 1
+            metrics.inc('bot_messages_total', (('queue', name), ('result', 'sent')))
+            logger.debug(f"Сообщение отправлено пользователю (ID: {chat_id})")
+            ok = True
+        except ApiTelegramException as e:
+            blocked = e.error_code == 403  # Пользователь заблокировал бота
+            with lock:
+                result['failed'] += 1
+                if blocked:
+                    result['blocked'].append(chat_id)
+            metrics.inc('bot_messages_total', (('queue', name), ('result', 'blocked' if blocked else 'failed')))
+            logger.debug(f"Ошибка отправки пользователю (ID: {chat_id}): {e}")
+            ok = False
+        except Exception as e:
+            with lock:
+                result['failed'] += 1
+            metrics.inc('bot_messages_total', (('queue', name), ('result', 'failed')))
+            logger.error(f"Ошибка отправки пользователю (ID: {chat_id}): {e}")
+            ok = False
+        finally:
+            slots.release()
+        if on_result:
+            on_result(chat_id, ok)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chat_id, message_text, reply_markup in messages:
+            if pacer:
+                pacer.acquire()
+            slots.acquire()
+            executor.submit(send, chat_id, message_text, reply_markup)
+    return result
+
+# Все апдейты проходят через два обработчика TeleBot, маршрут выбирает RouterMiddleware
+@bot.message_handler(content_types=['text'])
+def dispatch_message(message, data):
+    state = data['chat_state']
+    if state is None:
+        data['route'].handler(message)
+    else:
+        data['route'].handler(message, state.data)
+
+@bot.callback_query_handler(func=lambda call: True)
+def dispatch_callback(call, data):
+    data['route'].handler(call)
+
+@router.command('start')
 def start(message):
     add_user(message.from_user.id, message.from_user.username)
     bot.reply_to(message, "Привет! Я буду напоминать вам об оплате каждое первое число месяца.", reply_markup=get_user_keyboard())
     logger.info(f"Новый пользователь: {message.from_user.username} (ID: {message.from_user.id})")
 
-@bot.message_handler(func=lambda message: message.text == "📊 Статус")
+@router.text("📊 Статус")
 def status_command(message):
-    user_id = message.from_user.id
-    last_payment = get_last_payment(user_id)
+    bot.reply_to(message, format_status(get_last_payment(message.from_user.id)))
+
+def format_status(last_payment):
     if last_payment:
-        status_text = f"Ваша последняя подтвержденная оплата была {last_payment.payment_date.strftime('%Y-%m-%d %H:%M:%S')} за месяц {last_payment.month}."
-    else:
-        status_text = "У вас еще нет подтвержденных оплат."
-    bot.reply_to(message, status_text)
+        return f"Ваша последняя подтвержденная оплата была {last_payment.payment_date.strftime('%Y-%m-%d %H:%M:%S')} за месяц {last_payment.month}."
+    return "У вас еще нет подтвержденных оплат."
 
-@bot.message_handler(func=lambda message: message.text == "💰 Оплатить")
+@router.text("💰 Оплатить")
 def pay_command(message):
-    user_id = message.from_user.id
-    last_paid_month = get_last_paid_month(user_id)
-    
+    text, markup = render_pay_options(get_last_paid_month(message.from_user.id))
+    bot.send_message(message.chat.id, text, reply_markup=markup)
+
+PAY_MAX_MONTHS = 12
+
+def render_pay_options(last_paid_month):
+    # Текст и клавиатура выбора периода: от 1 до 12 месяцев, начиная со следующего за оплаченным
     if last_paid_month:
         start_date = last_paid_month + datetime.timedelta(days=32)
         start_date = start_date.replace(day=1)
+        text = f"Ваша текущая подписка оплачена до {last_paid_month.strftime('%d.%m.%Y')}. Выберите период для продления:"
     else:
         start_date = datetime.datetime.now().replace(day=1)
-    
+        text = "Выберите количество месяцев для оплаты:"
+    return text, get_pay_options_markup(start_date.strftime('%Y-%m'))
+
+@functools.lru_cache(maxsize=256)
+def get_pay_options_markup(start_month):
+    # Клавиатура зависит только от первого месяца периода и строится один раз на месяц
+    start_date = datetime.datetime.strptime(start_month, '%Y-%m')
     markup = InlineKeyboardMarkup()
-    for i in range(1, 13):  # Предлагаем от 1 до 12 месяцев
+    for i in range(1, PAY_MAX_MONTHS + 1):
         end_date = (start_date + datetime.timedelta(days=32*i)).replace(day=1) - datetime.timedelta(days=1)
         period = f"{start_date.strftime('%d.%m.%Y')}-{end_date.strftime('%d.%m.%Y')}"
-        markup.add(InlineKeyboardButton(f"{i} месяц(ев) ({period})", callback_data=f"pay_{i}_{start_date.strftime('%Y-%m')}"))
-    
-    if last_paid_month:
-        bot.send_message(message.chat.id, f"Ваша текущая подписка оплачена до {last_paid_month.strftime('%d.%m.%Y')}. Выберите период для продления:", reply_markup=markup)
-    else:
-        bot.send_message(message.chat.id, "Выберите количество месяцев для оплаты:", reply_markup=markup)
+        markup.add(InlineKeyboardButton(f"{i} месяц(ев) ({period})", callback_data=f"pay_{i}_{start_month}"))
+    return markup
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('pay_'))
-def handle_pay_selection(call):
-    _, num_months, start_month = call.data.split('_')
-    num_months = int(num_months)
-    amount = num_months * 100  # 100 RUB за месяц
-    
+@functools.lru_cache(maxsize=1024)
+def get_pay_selection_periods(start_month, num_months):
+    # ((месяц 'YYYY-MM', период 'дд.мм.гггг-дд.мм.гггг'), ...) для выбранного количества месяцев
     start_date = datetime.datetime.strptime(start_month, '%Y-%m')
     months = []
     for i in range(num_months):
@@ -229,276 +1661,1046 @@ def handle_pay_selection(call):
         current_date = current_date.replace(day=1)
         end_date = (current_date + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
         months.append((current_date.strftime('%Y-%m'), f"{current_date.strftime('%d.%m.%Y')}-{end_date.strftime('%d.%m.%Y')}"))
+    return tuple(months)
+
+def format_already_paid(already_paid_months):
+    return f"У вас уже есть оплата за следующие месяцы: {', '.join(already_paid_months)}. Выберите другой период."
+
+def render_payment_request(token, amount, months):
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("Оплатил", callback_data=f"paid:{token}"))
+    periods = ', '.join([period for _, period in months])
+    return f"Сумма к оплате: {amount} RUB за периоды: {periods}\nНажмите кнопку после оплаты:", markup
+
+@router.callback('pay_')
+def handle_pay_selection(call):
+    _, num_months, start_month = call.data.split('_')
+    num_months = int(num_months)
+    if not 1 <= num_months <= PAY_MAX_MONTHS:
+        # callback_data приходит от клиента: число месяцев не из клавиатуры не обрабатываем
+        bot.answer_callback_query(call.id)
+        return
+    amount = num_months * 100  # 100 RUB за месяц
+    months = get_pay_selection_periods(start_month, num_months)
     
     # Проверяем, есть ли уже оплата за выбранные месяцы
-    already_paid_months = [month for month, _ in months if is_payment_exists_for_month(call.from_user.id, month)]
+    already_paid_months = get_existing_payment_months(call.from_user.id, [month for month, _ in months])
     
     if already_paid_months:
-        bot.answer_callback_query(call.id, f"У вас уже есть оплата за следующие месяцы: {', '.join(already_paid_months)}. Выберите другой период.", show_alert=True)
+        bot.answer_callback_query(call.id, format_already_paid(already_paid_months), show_alert=True)
         return
     
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("Оплатил", callback_data=f"paid_{call.from_user.id}_{amount}_{','.join([m for m, _ in months])}"))
-    
-    periods = ', '.join([period for _, period in months])
-    bot.edit_message_text(f"Сумма к оплате: {amount} RUB за периоды: {periods}\nНажмите кнопку после оплаты:",
-                          call.message.chat.id,
-                          call.message.message_id,
-                          reply_markup=markup)
+    # Выбор сохраняется на сервере: список месяцев не помещается в 64 байта callback_data
+    token = create_payment_intent(call.from_user.id, amount, [month for month, _ in months])
+    text, markup = render_payment_request(token, amount, months)
+    bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
 
-@bot.message_handler(func=lambda message: message.text == "👨‍💼 Админ-панель")
+@router.text("👨‍💼 Админ-панель", admin=True, denied="У вас нет доступа к админ-панели.")
 def admin_panel(message):
-    if message.from_user.id != ADMIN_ID:
-        bot.reply_to(message, "У вас нет доступа к админ-панели.")
-        return
-    
     bot.send_message(message.chat.id, "Админ-панель:", reply_markup=get_admin_keyboard())
 
-@bot.message_handler(func=lambda message: message.text == "👤 Пользовательская панель")
+@router.text("👤 Пользовательская панель", admin=True, denied=ACCESS_DENIED)
 def user_panel(message):
-    if message.from_user.id != ADMIN_ID:
-        bot.reply_to(message, "У вас нет доступа к этой функции.")
-        return
-    
     bot.send_message(message.chat.id, "Пользовательская панель:", reply_markup=get_user_keyboard())
 
-@bot.message_handler(func=lambda message: message.from_user.id == ADMIN_ID and message.text == "👥 Список пользователей")
+@router.text("👥 Список пользователей", admin=True)
 def admin_users_list(message):
     users = get_all_users()
     user_list = "\n".join([f"{user[1]} (ID: {user[0]})" for user in users])
     bot.reply_to(message, f"Список пользователей:\n\n{user_list}")
 
-@bot.message_handler(func=lambda message: message.from_user.id == ADMIN_ID and message.text == "📈 Статистика оплат")
+def send_long_message(chat_id, lines, reply_markup=None):
+    # Разбивает текст по строкам на сообщения не длиннее MESSAGE_MAX_LENGTH, клавиатура у последнего
+    chunks = []
+    current = ""
+    for line in lines:
+        if current and len(current) + len(line) + 1 > MESSAGE_MAX_LENGTH:
+            chunks.append(current)
+            current = ""
+        current += line[:MESSAGE_MAX_LENGTH - 1] + "\n"
+    chunks.append(current or "-")
+    for i, chunk in enumerate(chunks):
+        bot.send_message(chat_id, chunk, reply_markup=reply_markup if i == len(chunks) - 1 else None)
+
+@router.text("📈 Статистика оплат", admin=True)
 def admin_payments_stats(message):
-    session = Session()
-    payments = session.query(Payment, User)\
-                      .join(User)\
-                      .filter(Payment.confirmed == True)\
-                      .order_by(User.username, Payment.payment_date)\
-                      .all()
-    session.close()
-
-    stats = {}
-    for payment, user in payments:
-        if user.username not in stats:
-            stats[user.username] = []
-        stats[user.username].append({
-            'date': payment.payment_date,
-            'month': payment.month,
-            'amount': payment.amount
-        })
-
-    response = "Статистика подтвержденных оплат:\n\n"
-    for username, user_payments in stats.items():
-        response += f"{username}:\n"
-        for payment in user_payments:
-            response += f" - {payment['date'].strftime('%d.%m.%Y')}: {payment['month']} ({payment['amount']} RUB)\n"
-        response += "\n"
-
-    bot.reply_to(message, response)
-
-@bot.message_handler(func=lambda message: message.from_user.id == ADMIN_ID and message.text == "📢 Отправить уведомление")
+    months = get_revenue_by_month()
+    if not months:
+        bot.reply_to(message, "Подтвержденных оплат пока нет.")
+        return
+
+    lines = ["Статистика подтвержденных оплат по месяцам:", ""]
+    for month, users, count, amount in months:
+        lines.append(f"{month}: {count} оплат от {users} польз., {amount} RUB")
+    lines.append("")
+    lines.append(f"Всего: {sum(m[2] for m in months)} оплат, {sum(m[3] for m in months)} RUB")
+
+    markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton("👥 По пользователям", callback_data="stats_users:new"),
+               InlineKeyboardButton("📄 Выгрузить CSV", callback_data="stats_csv"))
+    send_long_message(message.chat.id, lines, reply_markup=markup)
+
+def render_user_totals(cursor_user_id):
+    # cursor_user_id - последний пользователь предыдущей страницы (0 - первая страница)
+    after_key = None
+    if cursor_user_id:
+        with session_scope() as session:
+            after_key = session.query(username_key, User.id).filter(User.id == cursor_user_id).first()
+    rows = get_user_totals_page(tuple(after_key) if after_key else None, STATS_PAGE_SIZE)
+    has_next = len(rows) > STATS_PAGE_SIZE
+    rows = rows[:STATS_PAGE_SIZE]
+
+    lines = ["Подтвержденные оплаты по пользователям:", ""]
+    for user_id, username, _, count, amount in rows:
+        lines.append(f"{username} (ID: {user_id}): {count} оплат, {amount} RUB")
+    if not rows:
+        lines.append("Нет данных.")
+    markup = InlineKeyboardMarkup()
+    navigation = [InlineKeyboardButton("⏮ В начало", callback_data="stats_users:0")] if cursor_user_id else []
+    if has_next:
+        navigation.append(InlineKeyboardButton("➡️", callback_data=f"stats_users:{rows[-1][0]}"))
+    if navigation:
+        markup.row(*navigation)
+    return "\n".join(lines)[:MESSAGE_MAX_LENGTH], markup
+
+@router.callback('stats_users:', admin=True)
+def handle_stats_users_page(call):
+    # stats_users:new открывает отдельное сообщение, остальные страницы редактируют его
+    cursor = call.data.split(':')[1]
+    if cursor == 'new':
+        text, markup = render_user_totals(0)
+        bot.send_message(call.message.chat.id, text, reply_markup=markup)
+    else:
+        text, markup = render_user_totals(int(cursor))
+        edit_message_in_place(call, text, markup)
+    bot.answer_callback_query(call.id)
+
+@router.callback('stats_csv', admin=True)
+def handle_stats_csv(call):
+    bot.answer_callback_query(call.id, "Готовлю выгрузку...")
+    # До 1 МБ файл держится в памяти, дальше сбрасывается на диск
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as buffer:
+        text_buffer = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+        write_payments_csv(text_buffer)
+        text_buffer.flush()
+        buffer.seek(0)
+        bot.send_document(call.message.chat.id, buffer, visible_file_name=f"payments_{datetime.datetime.now().strftime('%Y%m%d')}.csv")
+        text_buffer.detach()
+
+@router.text("📢 Отправить уведомление", admin=True)
 def admin_send_notification(message):
-    msg = bot.reply_to(message, "Введите текст уведомления для отправки всем пользователям:")
-    bot.register_next_step_handler(msg, process_notification_text)
+    bot.reply_to(message, "Введите текст уведомления для отправки всем пользователям:")
+    chat_states.set(message.chat.id, 'notification_text')
 
-@bot.message_handler(func=lambda message: message.from_user.id == ADMIN_ID and message.text == "✅ Подтвердить оплаты")
+@router.text("✅ Подтвердить оплаты", admin=True)
 def admin_confirm_payments(message):
     confirm_payments_menu(message)
 
-@bot.message_handler(func=lambda message: message.from_user.id == ADMIN_ID and message.text == "❌ Удалить оплаты")
+@router.text("❌ Удалить оплаты", admin=True)
 def admin_delete_payments(message):
-    session = Session()
-    payments = session.query(Payment, User)\
-                      .join(User)\
-                      .order_by(User.username, Payment.month)\
-                      .all()
-    session.close()
-
-    if not payments:
-        bot.reply_to(message, "Нет оплат для удаления.")
-        return
-
-    markup = InlineKeyboardMarkup()
-    for payment, user in payments:
-        button_text = f"{user.username} - {payment.month} ({payment.amount} RUB)"
-        markup.add(InlineKeyboardButton(button_text, callback_data=f"delete_payment_{payment.id}"))
+    text, markup = render_payment_browser('d', 'a', 0, 0)
+    bot.reply_to(message, text, reply_markup=markup)
 
-    bot.reply_to(message, "Выберите оплату для удаления:", reply_markup=markup)
+@router.command('payments', admin=True)
+def admin_search_payments(message):
+    # /payments [ID или @username] [ГГГГ-ММ] [pending|confirmed|rejected]
+    status, user_id, month_key = 'a', 0, 0
+    for arg in message.text.split()[1:]:
+        if arg in PAYMENT_STATUS_ARGS:
+            status = PAYMENT_STATUS_ARGS[arg]
+        elif arg.isdigit():
+            user_id = int(arg)
+        elif arg.startswith('@'):
+            user_id = get_user_id_by_username(arg[1:]) or -1
+        else:
+            try:
+                datetime.datetime.strptime(arg, '%Y-%m')
+            except ValueError:
+                bot.reply_to(message, f"Неизвестный фильтр: {arg}")
+                return
+            month_key = month_to_key(arg)
+    text, markup = render_payment_browser('d', status, user_id, month_key)
+    bot.reply_to(message, text, reply_markup=markup)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('delete_payment_'))
+@router.callback('delete_payment_', admin=True)
 def delete_specific_payment(call):
-    if call.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(call.id, "У вас нет доступа к этой функции.")
-        return
-
     payment_id = int(call.data.split('_')[2])
     delete_payment(payment_id)
     bot.answer_callback_query(call.id, "Оплата удалена.")
     bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
     bot.send_message(call.message.chat.id, "Оплата успешно удалена.")
 
-def process_notification_text(message):
-    if message.from_user.id != ADMIN_ID:
-        return
-    
+# Постраничный просмотр оплат для администратора.
+# Страницы выбираются по ключу (username, month_key, id) после/до курсора, поэтому стоимость
+# страницы не зависит от размера таблицы. Состояние браузера целиком хранится в callback_data:
+#   pb:<режим>:<статус>:<user_id>:<month_key>:<направление>:<id курсора>  - навигация
+#   pa:<режим>:<id оплаты>:<статус>:<user_id>:<month_key>:<id первой строки> - действие над оплатой
+# Режимы: d - удаление, c - подтверждение. Направления: n - после курсора, p - до курсора, s - с курсора.
+PAYMENT_STATUS_FILTERS = {
+    'a': ("все", None),
+    'p': ("ожидают", (Payment.confirmed == False) & (Payment.rejected == False)),
+    'c': ("подтверждены", Payment.confirmed == True),
+    'r': ("отклонены", Payment.rejected == True),
+}
+PAYMENT_STATUS_ARGS = {'pending': 'p', 'confirmed': 'c', 'rejected': 'r', 'all': 'a'}
+PAYMENT_STATUS_CYCLE = {'a': 'p', 'p': 'c', 'c': 'r', 'r': 'a'}
+
+def get_user_id_by_username(username):
+    with session_scope() as session:
+        return session.query(User.id).filter(User.username == username).limit(1).scalar()
+
+def get_payment_browser_key(payment_id):
+    with session_scope() as session:
+        row = session.query(username_key, Payment.month_key, Payment.id)\
+                     .join(User)\
+                     .filter(Payment.id == payment_id)\
+                     .first()
+    return tuple(row) if row else None
+
+def get_payments_page(status, user_id, month_key, direction, key, limit):
+    # Возвращает до limit + 1 строк: лишняя строка означает, что в этом направлении есть еще страница
+    sort_key = tuple_(username_key, Payment.month_key, Payment.id)
+    with session_scope() as session:
+        query = session.query(Payment.id, Payment.user_id, User.username, Payment.month, Payment.amount,
+                              Payment.payment_date, Payment.confirmed, Payment.rejected)\
+                       .join(User)
+        status_filter = PAYMENT_STATUS_FILTERS[status][1]
+        if status_filter is not None:
+            query = query.filter(status_filter)
+        if user_id:
+            query = query.filter(Payment.user_id == user_id)
+        if month_key:
+            query = query.filter(Payment.month_key == month_key)
+        # Условие только по username_key дает поиск по индексу ix_users_username_key с позиции курсора:
+        # сравнение кортежей из столбцов двух таблиц SQLite использует лишь для фильтрации
+        if key and direction == 'p':
+            query = query.filter(username_seek(username_key <= key[0]), sort_key < tuple_(*key))\
+                         .order_by(username_key.desc(), Payment.month_key.desc(), Payment.id.desc())
+        else:
+            if key:
+                query = query.filter(username_seek(username_key >= key[0]),
+                                     sort_key > tuple_(*key) if direction == 'n' else sort_key >= tuple_(*key))
+            else:
+                query = query.filter(username_seek(username_key >= ''))
+            query = query.order_by(username_key, Payment.month_key, Payment.id)
+        return query.limit(limit + 1).all()
+
+def render_payment_browser(mode, status, user_id, month_key, direction='s', key=None, selected=frozenset()):
+    rows = get_payments_page(status, user_id, month_key, direction, key, PAYMENTS_PAGE_SIZE)
+    has_more = len(rows) > PAYMENTS_PAGE_SIZE
+    rows = rows[:PAYMENTS_PAGE_SIZE]
+    if direction == 'p':
+        rows.reverse()
+        if not rows:
+            return render_payment_browser(mode, status, user_id, month_key, selected=selected)
+    has_prev = has_more if direction == 'p' else key is not None
+    has_next = True if direction == 'p' else has_more
+
+    filters = f"{status}:{user_id}:{month_key}"
+    title = "Подтверждение оплат" if mode == 'c' else "Выберите оплату для удаления"
+    lines = [f"{title}", f"Статус: {PAYMENT_STATUS_FILTERS[status][0]}"]
+    if user_id:
+        lines.append(f"Пользователь: {user_id}")
+    if month_key:
+        lines.append(f"Месяц: {key_to_month(month_key)}")
+    if not rows:
+        lines.append("\nНет оплат по выбранным фильтрам.")
+
+    markup = InlineKeyboardMarkup()
+    anchor = rows[0].id if rows else 0
+    if mode == 'c':
+        # Месяцы одной оплаты (общая payment_date) идут подряд и показываются одной строкой;
+        # кнопки передают ID первого месяца, обработчики расширяют его до всей оплаты (get_payment_group_ids)
+        groups = []
+        for row in rows:
+            if groups and (groups[-1][0].user_id, groups[-1][0].payment_date) == (row.user_id, row.payment_date):
+                groups[-1].append(row)
+            else:
+                groups.append([row])
+        for group in groups:
+            row = group[0]
+            label = f"{row.username} - {', '.join(r.month for r in group)} ({sum(r.amount for r in group)} RUB)"
+            mark = "☑️" if row.id in selected else "⬜"
+            markup.row(InlineKeyboardButton(f"{mark} {label}", callback_data=f"pa:t:{row.id}:{filters}:{anchor}"),
+                       InlineKeyboardButton("✅", callback_data=f"pa:c:{row.id}:{filters}:{anchor}"),
+                       InlineKeyboardButton("❌", callback_data=f"reject_payment_{row.id}"))
+    else:
+        for row in rows:
+            label = f"{row.username} - {row.month} ({row.amount} RUB)"
+            mark = "✅" if row.confirmed else "🚫" if row.rejected else "⏳"
+            markup.add(InlineKeyboardButton(f"🗑 {mark} {label}", callback_data=f"pa:d:{row.id}:{filters}:{anchor}"))
+    navigation = []
+    if has_prev and rows:
+        navigation.append(InlineKeyboardButton("⬅️", callback_data=f"pb:{mode}:{filters}:p:{rows[0].id}"))
+    if mode != 'c':
+        next_status = PAYMENT_STATUS_CYCLE[status]
+        navigation.append(InlineKeyboardButton(f"Статус: {PAYMENT_STATUS_FILTERS[next_status][0]}",
+                                               callback_data=f"pb:{mode}:{next_status}:{user_id}:{month_key}:s:0"))
+    if has_next and rows:
+        navigation.append(InlineKeyboardButton("➡️", callback_data=f"pb:{mode}:{filters}:n:{rows[-1].id}"))
+    if navigation:
+        markup.row(*navigation)
+    if mode == 'c' and rows:
+        markup.row(InlineKeyboardButton("✅ Все ожидающие", callback_data="bulk:ask:all"),
+                   InlineKeyboardButton("📅 Все за месяц", callback_data="bulk:months"))
+    if mode == 'c' and selected:
+        markup.row(InlineKeyboardButton(f"✅ Выбранные ({len(selected)})", callback_data="bulk:do:sel"),
+                   InlineKeyboardButton(f"❌ Выбранные ({len(selected)})", callback_data="bulk:rej:sel"),
+                   InlineKeyboardButton("Сбросить", callback_data="bulk:clear"))
+    return "\n".join(lines), markup
+
+def edit_message_in_place(call, text, markup):
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    except ApiTelegramException as e:
+        if 'message is not modified' not in str(e):
+            raise
+
+@router.callback('pb:', admin=True)
+def handle_payment_browser_page(call):
+    _, mode, status, user_id, month_key, direction, cursor = call.data.split(':')
+    key = get_payment_browser_key(int(cursor)) if int(cursor) else None
+    if key is None:
+        direction = 's'
+    text, markup = render_payment_browser(mode, status, int(user_id), int(month_key), direction, key,
+                                          selected=payment_selections.get(call.message.chat.id, frozenset()))
+    edit_message_in_place(call, text, markup)
+    bot.answer_callback_query(call.id)
+
+@router.callback('pa:', admin=True)
+def handle_payment_browser_action(call):
+    # Действия: c - подтвердить, d - удалить, t - отметить для массового действия
+    _, action, payment_id, status, user_id, month_key, anchor = call.data.split(':')
+    payment_id = int(payment_id)
+    # Позиция страницы запоминается до изменения: первая строка может быть удалена действием
+    key = get_payment_browser_key(int(anchor))
+    selected = payment_selections.setdefault(call.message.chat.id, set())
+    if action == 't':
+        group_ids = get_payment_group_ids([payment_id])
+        if payment_id in selected:
+            selected.difference_update(group_ids)
+        else:
+            selected.update(group_ids)
+        bot.answer_callback_query(call.id)
+    elif action == 'c':
+        group_ids = get_payment_group_ids([payment_id])
+        confirm_payments(group_ids)
+        selected.difference_update(group_ids)
+        bot.answer_callback_query(call.id, "Оплата подтверждена.")
+    else:
+        delete_payment(payment_id)
+        bot.answer_callback_query(call.id, "Оплата удалена.")
+    mode = 'd' if action == 'd' else 'c'
+    text, markup = render_payment_browser(mode, status, int(user_id), int(month_key), 's', key, selected=selected)
+    edit_message_in_place(call, text, markup)
+
+# Оплаты, отмеченные администратором для массового подтверждения/отклонения: chat_id -> {payment_id}
+payment_selections = {}
+
+def notify_users_in_background(messages):
+    # Уведомления уходят пачкой через общий ограничитель скорости, не задерживая обработчик
+    messages = list(messages)
+    if messages:
+        threading.Thread(target=dispatch_messages, args=(messages,), daemon=True).start()
+
+class AdminNotifier:
+    # Уведомления администратору из обработчиков отправляет фоновый поток. Пока он ждет лимита
+    # чата администратора (CHAT_SEND_RATE), новые уведомления копятся и уходят одним сообщением.
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def notify(self, text):
+        self.queue.put(text)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='admin-notifier', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            lines = [self.queue.get()]
+            while True:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            metrics.set('bot_send_queue_depth', len(lines), (('queue', 'admin'),))
+            try:
+                send_long_message(self.chat_id, lines)
+            except Exception as e:
+                logger.error(f"Не удалось отправить администратору {len(lines)} уведомлений: {e}")
+            metrics.set('bot_send_queue_depth', 0, (('queue', 'admin'),))
+
+admin_notifier = AdminNotifier(ADMIN_ID)
+
+def notify_payment_confirmations(confirmed):
+    notify_users_in_background(
+        (user_id, f"Ваша оплата за {', '.join(sorted(months))} подтверждена. Спасибо!", None)
+        for user_id, months in confirmed.items()
+    )
+
+def get_back_to_confirm_markup():
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("⬅️ К списку оплат", callback_data="pb:c:p:0:0:s:0"))
+    return markup
+
+@router.callback('bulk:', admin=True)
+def handle_bulk_payments(call):
+    # bulk:months, bulk:ask:all|m:<key>, bulk:do:all|m:<key>|sel, bulk:rej:sel, bulk:clear
+    action, *args = call.data.split(':')[1:]
+    chat_id = call.message.chat.id
+    if action == 'months':
+        markup = InlineKeyboardMarkup()
+        for month_key, count in get_pending_months():
+            markup.add(InlineKeyboardButton(f"{key_to_month(month_key)} ({count})", callback_data=f"bulk:ask:m:{month_key}"))
+        markup.add(InlineKeyboardButton("⬅️ К списку оплат", callback_data="pb:c:p:0:0:s:0"))
+        edit_message_in_place(call, "Выберите месяц, за который подтвердить все ожидающие оплаты:", markup)
+    elif action == 'ask':
+        month_key = int(args[1]) if args[0] == 'm' else None
+        scope = f"за {key_to_month(month_key)}" if month_key else "за все месяцы"
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("Да, подтвердить", callback_data=f"bulk:do:{':'.join(args)}"),
+                   InlineKeyboardButton("Отмена", callback_data="pb:c:p:0:0:s:0"))
+        edit_message_in_place(call, f"Подтвердить {count_pending_payments(month_key)} ожидающих оплат {scope}?", markup)
+    elif action == 'do':
+        if args[0] == 'sel':
+            payment_ids = payment_selections.pop(chat_id, set())
+            confirmed = confirm_pending_payments(payment_ids=payment_ids) if payment_ids else {}
+        else:
+            confirmed = confirm_pending_payments(month_key=int(args[1]) if args[0] == 'm' else None)
+        notify_payment_confirmations(confirmed)
+        total = sum(len(months) for months in confirmed.values())
+        logger.info(f"Массово подтверждено {total} оплат от {len(confirmed)} пользователей")
+        edit_message_in_place(call, f"Подтверждено оплат: {total} от {len(confirmed)} пользователей. Уведомления отправляются.",
+                              get_back_to_confirm_markup())
+    elif action == 'rej':
+        payment_ids = list(payment_selections.pop(chat_id, set()))
+        if payment_ids:
+            bot.send_message(chat_id, f"Введите комментарий для отклонения {len(payment_ids)} платежей:")
+            chat_states.set(chat_id, 'reject_comment', {'payment_ids': payment_ids})
+    elif action == 'clear':
+        payment_selections.pop(chat_id, None)
+        text, markup = render_payment_browser('c', 'p', 0, 0)
+        edit_message_in_place(call, text, markup)
+    bot.answer_callback_query(call.id)
+
+@router.state('notification_text', admin=True)
+def process_notification_text(message, data):
+    chat_states.delete(message.chat.id)
     notification_text = message.text
-    send_notification_to_all(notification_text)
-    bot.reply_to(message, "Уведомление отправлено всем пользователям.")
+    job_id = send_notification_to_all(notification_text, message.chat.id)
+    bot.reply_to(message, f"Рассылка #{job_id} поставлена в очередь. Прогресс будет обновляться в сообщении выше.")
 
-def send_notification_to_all(message):
-    users = get_all_users()
-    for user_id, username in users:
+def send_notification_to_all(message, admin_chat_id=ADMIN_ID):
+    # Рассылка сохраняется как задание с получателями в базе и выполняется в фоне
+    progress = bot.send_message(admin_chat_id, "Рассылка запускается...")
+    with session_scope() as session:
+        job = BroadcastJob(text=message, admin_chat_id=admin_chat_id, progress_message_id=progress.message_id)
+        session.add(job)
+        session.flush()
+        session.execute(insert(BroadcastRecipient).from_select(
+            ['job_id', 'user_id', 'status'],
+            select(literal(job.id), User.id, literal('pending'))
+        ))
+        # Задание должно быть зафиксировано до запуска фонового потока. Внутри апдейта это общая сессия,
+        # поэтому вместе с заданием фиксируется и удаление состояния чата: вторая сессия ждала бы
+        # блокировку записи, которую держит эта.
+        session.commit()
+        job_id = job.id
+    logger.info(f"Создана рассылка #{job_id}")
+    if scheduler_lease.held:
+        start_broadcast(job_id)
+    else:
+        # Рассылки выполняет ведущий экземпляр: он подхватит задание при следующем продлении аренды
+        logger.info(f"Рассылка #{job_id} будет запущена ведущим экземпляром")
+    return job_id
+
+# Рассылки, выполняемые в этом процессе: ведущий экземпляр периодически возобновляет задания,
+# и одно задание не должно выполняться двумя потоками
+active_broadcasts = set()
+active_broadcasts_lock = threading.Lock()
+
+def start_broadcast(job_id):
+    with active_broadcasts_lock:
+        if job_id in active_broadcasts:
+            return None
+
+        active_broadcasts.add(job_id)
+
+    def run():
         try:
-            bot.send_message(user_id, message)
-            logger.info(f"Уведомление отправлено пользователю {username} (ID: {user_id})")
-        except ApiTelegramException as e:
-            logger.error(f"Ошибка отправки уведомления пользователю {username} (ID: {user_id}): {e}")
+            run_broadcast(job_id)
+        finally:
+            with active_broadcasts_lock:
+                active_broadcasts.discard(job_id)
+
+    thread = threading.Thread(target=run, name=f"broadcast-{job_id}", daemon=True)
+    thread.start()
+    return thread
+
+def resume_broadcasts():
+    with session_scope() as session:
+        job_ids = [job_id for job_id, in session.query(BroadcastJob.id).filter_by(status='running')]
+    for job_id in job_ids:
+        if start_broadcast(job_id):
+            logger.info(f"Возобновление рассылки #{job_id}")
+
+def get_broadcast_counts(job_id):
+    with session_scope() as session:
+        return dict(session.query(BroadcastRecipient.status, func.count('*'))
+                           .filter_by(job_id=job_id)
+                           .group_by(BroadcastRecipient.status)
+                           .all())
+
+def report_broadcast_progress(job, counts, rate, finished=False):
+    title = "Рассылка завершена" if finished else "Рассылка выполняется"
+    text = (f"{title} #{job.id}\n"
+            f"Отправлено: {counts.get('sent', 0)}\n"
+            f"Ошибок: {counts.get('failed', 0)}\n"
+            f"Осталось: {counts.get('pending', 0)}\n"
+            f"Скорость: {rate:.1f} сообщ./с")
+    try:
+        bot.edit_message_text(text, job.admin_chat_id, job.progress_message_id)
+    except ApiTelegramException as e:
+        logger.debug(f"Не удалось обновить прогресс рассылки #{job.id}: {e}")
+
+def run_broadcast(job_id):
+    with session_scope() as session:
+        job = session.query(BroadcastJob).filter_by(id=job_id).first()
+    if not job or job.status != 'running':
+        return
+
+    counts = get_broadcast_counts(job_id)
+    started = time.monotonic()
+    processed = 0
+    last_user_id = 0
+    while True:
+        if not scheduler_lease.held:
+            # Роль перешла другому экземпляру, он продолжит с неотправленных получателей
+            logger.warning(f"Рассылка #{job_id} приостановлена: экземпляр больше не ведущий")
+            return
+        with session_scope() as session:
+            user_ids = [user_id for user_id, in session.query(BroadcastRecipient.user_id)
+                                                       .filter(BroadcastRecipient.job_id == job_id,
+                                                               BroadcastRecipient.status == 'pending',
+                                                               BroadcastRecipient.user_id > last_user_id)
+                                                       .order_by(BroadcastRecipient.user_id)
+                                                       .limit(BROADCAST_CHUNK_SIZE)]
+        if not user_ids:
+            break
+        last_user_id = user_ids[-1]
+
+        outcomes = {'sent': [], 'failed': []}
+        dispatch_messages(((user_id, job.text, None) for user_id in user_ids),
+                          on_result=lambda chat_id, ok: outcomes['sent' if ok else 'failed'].append(chat_id),
+                          name='broadcast')
+
+        # Статусы получателей фиксируются пачкой: после падения повторно уйдет не больше одной пачки
+        with session_scope() as session:
+            for status, ids in outcomes.items():
+                if ids:
+                    session.query(BroadcastRecipient)\
+                           .filter(BroadcastRecipient.job_id == job_id, BroadcastRecipient.user_id.in_(ids))\
+                           .update({BroadcastRecipient.status: status}, synchronize_session=False)
+                    counts[status] = counts.get(status, 0) + len(ids)
+        counts['pending'] = counts.get('pending', 0) - len(user_ids)
+        metrics.set('bot_send_queue_depth', counts['pending'], (('queue', 'broadcast'),))
+        processed += len(user_ids)
+        report_broadcast_progress(job, counts, processed / max(time.monotonic() - started, 0.001))
 
-def send_reminders():
-    current_date = datetime.datetime.now()
+    with session_scope() as session:
+        session.query(BroadcastJob).filter_by(id=job_id).update({BroadcastJob.status: 'done', BroadcastJob.finished_at: datetime.datetime.utcnow()})
+    metrics.set('bot_send_queue_depth', 0, (('queue', 'broadcast'),))
+    report_broadcast_progress(job, counts, processed / max(time.monotonic() - started, 0.001), finished=True)
+    logger.info(f"Рассылка #{job_id} завершена: отправлено {counts.get('sent', 0)}, ошибок {counts.get('failed', 0)}")
+
+# Виды напоминаний, полностью разосланные в этом процессе: (месяц, вид)
+completed_reminders = set()
+
+def get_due_reminder(now):
+    # Последний наступивший день расписания в текущем месяце. Пропущенные более ранние
+    # напоминания не досылаются: пользователь сразу получает актуальное.
+    due_days = [day for day in REMINDER_DAYS if day <= now.day]
+    if not due_days:
+        return None, None
+    kind = f"day{due_days[-1]}"
+    previous = f"day{due_days[-2]}" if len(due_days) > 1 else None
+    return kind, previous
+
+def has_reminder_deliveries(month, kind):
+    with session_scope() as session:
+        return session.query(ReminderDelivery.user_id)\
+                      .filter_by(month_key=month_to_key(month), kind=kind)\
+                      .first() is not None
+
+def send_reminders(now=None):
+    current_date = now or datetime.datetime.now()
     current_month = current_date.strftime('%Y-%m')
-    logger.info(f"Проверка напоминаний: {current_date}")
-    if current_date.day == 1:
-        for user_id, username in get_all_users():
-            if not is_payment_confirmed_for_month(user_id, current_month):
-                try:
-                    markup = InlineKeyboardMarkup()
-                    markup.row(InlineKeyboardButton("Оплатить", callback_data=f"pay_1_{current_month}"))
-                    bot.send_message(user_id, f"Привет! Напоминаем об оплате за {current_month}.", reply_markup=markup)
-                    logger.info(f"Отправлено напоминание пользователю {username} (ID: {user_id})")
-                except ApiTelegramException as e:
-                    if e.error_code == 403:  # Пользователь заблокировал бота
-                        remove_user(user_id)
-                        logger.warning(f"Пользователь {username} (ID: {user_id}) удален из-за блокировки бота")
+    kind, previous = get_due_reminder(current_date)
+    if kind is None or (current_month, kind) in completed_reminders:
+        return
+    logger.info(f"Проверка напоминаний {kind} за {current_month}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('paid_'))
+    # Повторное напоминание получают те, кому ушло предыдущее, без просмотра всей таблицы users.
+    # Если предыдущего не было (бот не работал), кандидаты берутся из всех пользователей.
+    reminded = previous if previous and has_reminder_deliveries(current_month, previous) else None
+    total = count_unpaid_users(current_month, not_reminded=kind, reminded=reminded)
+    if total:
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("Оплатить", callback_data=f"pay_1_{current_month}"))
+        if reminded is None:
+            text = f"Привет! Напоминаем об оплате за {current_month}."
+        else:
+            text = f"Напоминаем, что оплата за {current_month} еще не поступила."
+
+        # Отправка растягивается на REMINDER_WINDOW, но не быстрее общего лимита
+        pacer = TokenBucket(max(total / REMINDER_WINDOW, 1 / 60), capacity=1)
+        sent_ids = []
+        remaining = [total]
+        lock = threading.Lock()
+        metrics.set('bot_send_queue_depth', total, (('queue', 'reminders'),))
+
+        def on_result(chat_id, ok):
+            with lock:
+                remaining[0] -= 1
+                metrics.set('bot_send_queue_depth', max(remaining[0], 0), (('queue', 'reminders'),))
+            if not ok:
+                return
+            with lock:
+                sent_ids.append(chat_id)
+                batch = sent_ids[:] if len(sent_ids) >= REMINDER_RECORD_BATCH else None
+                if batch:
+                    sent_ids.clear()
+            if batch:
+                record_reminder_deliveries(current_month, kind, batch)
+
+        # Отправка прекращается, если экземпляр потерял роль ведущего: остаток разошлет новый ведущий
+        messages = itertools.takewhile(lambda _: scheduler_lease.held, (
+            (user_id, text, markup)
+            for user_id, _ in iter_unpaid_users(current_month, not_reminded=kind, reminded=reminded)))
+        result = dispatch_messages(messages, on_result=on_result, pacer=pacer, name='reminders')
+        record_reminder_deliveries(current_month, kind, sent_ids)
+        metrics.set('bot_send_queue_depth', 0, (('queue', 'reminders'),))
+        if not scheduler_lease.held:
+            logger.warning(f"Напоминания {kind} за {current_month} прерваны: экземпляр больше не ведущий")
+            return
+        if result['blocked']:
+            remove_users(result['blocked'])
+            logger.warning(f"Удалено {len(result['blocked'])} пользователей из-за блокировки бота")
+        logger.info(f"Напоминания {kind} за {current_month}: отправлено {result['sent']}, ошибок {result['failed']}")
+        if result['failed'] > len(result['blocked']):
+            # Часть сообщений не ушла: повторим при следующей проверке
+            return
+    completed_reminders.add((current_month, kind))
+
+@router.callback('paid:')
 def handle_payment(call):
+    intent = take_payment_intent(call.data.split(':')[1], call.from_user.id)
+    if intent is None:
+        bot.answer_callback_query(call.id, "Выбор периода устарел. Нажмите «💰 Оплатить» и выберите период заново.", show_alert=True)
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        return
+    amount, months = intent
+    register_payment(call, call.from_user.id, amount, months)
+
+@router.callback('paid_')
+def handle_legacy_payment(call):
+    # Кнопки в сообщениях, отправленных до появления payment_intents: paid_<user_id>_<сумма>_<месяцы>
     _, user_id, amount, months = call.data.split('_')
-    user_id = int(user_id)
-    amount = int(amount)
-    months = months.split(',')
-    
-    # Дополнительная проверка перед созданием платежа
-    already_paid_months = [month for month in months if is_payment_exists_for_month(user_id, month)]
+    # user_id в данных кнопки не проверен: оплату можно зарегистрировать только за себя
+    if int(user_id) != call.from_user.id:
+        logger.warning(f"Пользователь {call.from_user.id} нажал кнопку оплаты пользователя {user_id}")
+        bot.answer_callback_query(call.id, ACCESS_DENIED, show_alert=True)
+        return
+    register_payment(call, int(user_id), int(amount), months.split(','))
+
+def register_payment(call, user_id, amount, months):
+    # За время жизни намерения месяц мог быть оплачен другой кнопкой
+    already_paid_months = add_new_payment(user_id, amount, months)
     if already_paid_months:
         bot.answer_callback_query(call.id, f"Оплата за месяцы {', '.join(already_paid_months)} уже существует. Платеж не создан.", show_alert=True)
         bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
         return
     
-    payment_ids = add_payment(user_id, amount, months)
     logger.info(f"Получена неподтвержденная оплата от пользователя {call.from_user.username} (ID: {user_id}) за месяцы: {', '.join(months)}")
     bot.answer_callback_query(call.id, "Спасибо за оплату! Администратор проверит и подтвердит её.")
     bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
     
     # Уведомляем администратора о новой оплате
-    bot.send_message(ADMIN_ID, f"Новая оплата от пользователя {call.from_user.username} (ID: {user_id}) за месяцы: {', '.join(months)}. Используйте команду '✅ Подтвердить оплаты' для подтверждения.")
+    admin_notifier.notify(f"Новая оплата от пользователя {call.from_user.username} (ID: {user_id}) за месяцы: {', '.join(months)}. Используйте команду '✅ Подтвердить оплаты' для подтверждения.")
 
 def confirm_payments_menu(message):
-    if message.from_user.id != ADMIN_ID:
-        bot.reply_to(message, "У вас нет доступа к этой функции.")
-        return
+    text, markup = render_payment_browser('c', 'p', 0, 0, selected=payment_selections.get(message.chat.id, frozenset()))
+    bot.reply_to(message, text, reply_markup=markup)
 
-    session = Session()
-    unconfirmed_payments = session.query(Payment, User).join(User).filter(Payment.confirmed == False, Payment.rejected == False).all()
-    session.close()
-
-    if not unconfirmed_payments:
-        bot.reply_to(message, "Нет неподтвержденных оплат.")
-        return
-
-    grouped_payments = {}
-    for payment, user in unconfirmed_payments:
-        key = (user.id, user.username, payment.payment_date)
-        if key not in grouped_payments:
-            grouped_payments[key] = []
-        grouped_payments[key].append(payment)
-
-    for (user_id, username, payment_date), payments in grouped_payments.items():
-        total_amount = sum(payment.amount for payment in payments)
-        months = ", ".join(payment.month for payment in payments)
-        markup = InlineKeyboardMarkup()
-        markup.row(
-            InlineKeyboardButton("Подтвердить", callback_data=f"confirm_payment_{'_'.join([str(p.id) for p in payments])}"),
-            InlineKeyboardButton("Отклонить", callback_data=f"reject_payment_{'_'.join([str(p.id) for p in payments])}")
-        )
-        bot.send_message(message.chat.id, 
-                         f"Оплата от {username} (ID: {user_id})\n"
-                         f"Дата: {payment_date}\n"
-                         f"Месяцы: {months}\n"
-                         f"Общая сумма: {total_amount} RUB", 
-                         reply_markup=markup)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith('confirm_payment_'))
+@router.callback('confirm_payment_', admin=True)
 def confirm_specific_payment(call):
-    if call.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(call.id, "У вас нет доступа к этой функции.")
-        return
-
-    payment_ids = [int(pid) for pid in call.data.split('_')[2:]]
-    for payment_id in payment_ids:
-        confirm_payment(payment_id)
+    payment_ids = get_payment_group_ids([int(pid) for pid in call.data.split('_')[2:]])
+    confirm_payments(payment_ids)
     bot.answer_callback_query(call.id, "Оплата подтверждена.")
     bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
     bot.send_message(call.message.chat.id, "Оплата успешно подтверждена.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('reject_payment_'))
+@router.callback('reject_payment_', admin=True)
 def reject_specific_payment(call):
-    if call.from_user.id != ADMIN_ID:
-        bot.answer_callback_query(call.id, "У вас нет доступа к этой функции.")
-        return
-
-    payment_ids = [int(pid) for pid in call.data.split('_')[2:]]
-    msg = bot.send_message(call.message.chat.id, "Введите комментарий для отклонения платежа:")
-    bot.register_next_step_handler(msg, process_reject_comment, payment_ids)
+    payment_ids = get_payment_group_ids([int(pid) for pid in call.data.split('_')[2:]])
+    bot.send_message(call.message.chat.id, "Введите комментарий для отклонения платежа:")
+    chat_states.set(call.message.chat.id, 'reject_comment', {'payment_ids': payment_ids})
 
-def process_reject_comment(message, payment_ids):
+@router.state('reject_comment', admin=True)
+def process_reject_comment(message, data):
+    chat_states.delete(message.chat.id)
+    payment_ids = data['payment_ids']
     comment = message.text
-    user_id = None
-    for payment_id in payment_ids:
-        user_id = reject_payment(payment_id, comment)
-    if user_id:
-        bot.send_message(message.chat.id, "Платеж отклонен.")
+    user_ids = reject_payments(payment_ids, comment)
+    if user_ids:
+        bot.send_message(message.chat.id, "Платеж отклонен." if len(payment_ids) == 1 else f"Отклонено платежей: {len(payment_ids)}.")
         markup = InlineKeyboardMarkup()
         markup.row(InlineKeyboardButton("Оплатить снова", callback_data=f"pay_1_{datetime.datetime.now().strftime('%Y-%m')}"))
-        bot.send_message(user_id, f"Ваш платеж был отклонен. Комментарий: {comment}", reply_markup=markup)
+        notify_users_in_background((user_id, f"Ваш платеж был отклонен. Комментарий: {comment}", markup) for user_id in user_ids)
     else:
         bot.send_message(message.chat.id, "Ошибка при отклонении платежа.")
         
-@bot.message_handler(func=lambda message: message.from_user.id == ADMIN_ID and message.text == "🔍 Неоплатившие пользователи")
+@router.text("🔍 Неоплатившие пользователи", admin=True)
 def users_without_payment(message):
     current_month = datetime.datetime.now().strftime('%Y-%m')
-    session = Session()
-    users_with_payment = session.query(User.id).join(Payment).filter(
-        Payment.month == current_month,
-        Payment.confirmed == True
-    ).distinct()
-    
-    users_without_payment = session.query(User).filter(~User.id.in_(users_with_payment)).all()
-    session.close()
+    with session_scope() as session:
+        # Диапазон по индексу ix_subscriptions_paid_through
+        users_without_payment = session.query(User.id, User.username)\
+                                       .join(Subscription, Subscription.user_id == User.id)\
+                                       .filter(Subscription.paid_through_month < month_to_key(current_month))\
+                                       .all()
 
     if not users_without_payment:
         bot.reply_to(message, "Все пользователи внесли оплату в текущем месяце.")
     else:
-        response = "Пользователи, не внесшие оплату в текущем месяце:\n\n"
-        for user in users_without_payment:
-            response += f"- {user.username} (ID: {user.id})\n"
-        bot.reply_to(message, response)
+        lines = ["Пользователи, не внесшие оплату в текущем месяце:", ""]
+        lines.extend(f"- {user.username} (ID: {user.id})" for user in users_without_payment)
+        send_long_message(message.chat.id, lines)
+
+@router.command('cache', admin=True)
+def admin_cache_stats(message):
+    stats = subscription_cache.stats()
+    bot.reply_to(message, f"Кэш подписок: {stats['size']} записей, попаданий {stats['hits']}, "
+                          f"промахов {stats['misses']}, вытеснений {stats['evictions']}")
+
+def collect_runtime_metrics():
+    stats = subscription_cache.stats()
+    collected = [('bot_subscription_cache_' + name, (), value) for name, value in stats.items()]
+    if webhook_pool is not None:
+        collected.append(('bot_update_queue_depth', (), webhook_pool.depth()))
+    collected.append(('bot_scheduler_leader', (), int(scheduler_lease.held)))
+    return collected
+
+metrics.add_collector(collect_runtime_metrics)
+
+def acquire_lease(name, holder, ttl):
+    # Аренда продлевается текущим владельцем или перехватывается, если владелец не продлил её вовремя.
+    # Время берется по часам экземпляра, поэтому часы экземпляров должны быть синхронизированы.
+    now = datetime.datetime.utcnow()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    with session_scope() as session:
+        acquired = session.execute(update(Lease)
+                                   .where(Lease.name == name, (Lease.holder == holder) | (Lease.expires_at < now))
+                                   .values(holder=holder, expires_at=expires_at)).rowcount
+        if acquired:
+            return True
+        if session.get(Lease, name) is not None:
+            return False
+    try:
+        with session_scope() as session:
+            session.execute(insert(Lease).values(name=name, holder=holder, expires_at=expires_at))
+        return True
+    except IntegrityError:
+        # Другой экземпляр создал аренду одновременно с нами
+        return False
+
+def release_lease(name, holder):
+    with session_scope() as session:
+        session.execute(delete(Lease).where(Lease.name == name, Lease.holder == holder))
+
+class LeaderLease:
+    # Роль, которую в каждый момент выполняет не больше одного экземпляра бота.
+    # Экземпляр считает роль своей не дольше ttl с начала последнего успешного продления,
+    # а запись в базе живет не меньше, поэтому два экземпляра не считают себя ведущими одновременно.
+    def __init__(self, name, holder, ttl, interval, on_held=None):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.interval = interval
+        self.on_held = on_held
+        self.held_until = 0
+        self.gained = threading.Event()
+        self.stopped = threading.Event()
+
+    @property
+    def held(self):
+        return time.monotonic() < self.held_until
+
+    def renew(self):
+        started = time.monotonic()
+        was_held = self.held
+        try:
+            if acquire_lease(self.name, self.holder, self.ttl):
+                self.held_until = started + self.ttl
+            else:
+                self.held_until = 0
+        except Exception as e:
+            # База недоступна: роль истечет сама, если продлить её не удастся до конца срока
+            logger.error(f"Не удалось продлить аренду {self.name}: {e}")
+        if self.held and not was_held:
+            logger.info(f"Экземпляр {self.holder} стал ведущим ({self.name})")
+            self.gained.set()
+        elif was_held and not self.held:
+            logger.warning(f"Экземпляр {self.holder} больше не ведущий ({self.name})")
+        return self.held
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.renew() and self.on_held:
+                try:
+                    self.on_held()
+                except Exception as e:
+                    logger.error(f"Ошибка задачи ведущего экземпляра ({self.name}): {e}")
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, name=f"lease-{self.name}", daemon=True).start()
+        return self
+
+    def release(self):
+        # Освобождение при остановке: другой экземпляр получит роль, не дожидаясь истечения аренды
+        self.stopped.set()
+        if self.held:
+            self.held_until = 0
+            release_lease(self.name, self.holder)
+            logger.info(f"Экземпляр {self.holder} освободил роль ведущего ({self.name})")
+
+# Напоминания и рассылки выполняет только ведущий экземпляр. Он же возобновляет рассылки,
+# прерванные перезапуском или отказом предыдущего ведущего.
+scheduler_lease = LeaderLease('scheduler', INSTANCE_ID, LEASE_TTL, LEASE_RENEW_INTERVAL, on_held=resume_broadcasts)
 
 def main():
+    # Проверка расписания идемпотентна: журнал reminder_deliveries не дает отправить напоминание дважды,
+    # а напоминания, пропущенные во время простоя, отправляются при первой проверке после запуска.
+    # Новый ведущий экземпляр проверяет расписание сразу, не дожидаясь REMINDER_CHECK_INTERVAL.
+    while not scheduler_lease.stopped.is_set():
+        scheduler_lease.gained.clear()
+        if scheduler_lease.held:
+            run_scheduled_jobs()
+        scheduler_lease.gained.wait(REMINDER_CHECK_INTERVAL)
+
+def run_scheduled_jobs():
+    try:
+        send_reminders()
+        purge_expired_payment_intents()
+        chat_states.purge_expired()
+    except Exception as e:
+        logger.error(f"Произошла ошибка: {e}")
+
+def get_update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return update.update_id
+
+class UpdateWorkerPool:
+    # Апдейты одного чата всегда попадают в одну очередь и обрабатываются по порядку,
+    # разные чаты обрабатываются параллельно
+    def __init__(self, workers, queue_size):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        for i, updates in enumerate(self.queues):
+            threading.Thread(target=self.work, args=(updates,), name=f"update-worker-{i}", daemon=True).start()
+
+    def submit(self, update, block=False):
+        # False, если очередь переполнена: вызывающий должен попросить Telegram повторить позже
+        updates = self.queues[get_update_chat_id(update) % len(self.queues)]
+        try:
+            updates.put(update, block=block)
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self):
+        return sum(updates.qsize() for updates in self.queues)
+
+    def work(self, updates):
+        while True:
+            update = updates.get()
+            try:
+                bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                updates.task_done()
+
+def apply_cache_invalidations(invalidations):
     while True:
+        source, user_ids = invalidations.get()
+        if source != os.getpid():
+            subscription_cache.invalidate(user_ids)
+
+def run_update_process(updates, changes, invalidations):
+    # Точка входа процесса обработки апдейтов: модуль импортируется заново (spawn),
+    # напоминания и рассылки здесь не запускаются
+    global cache_invalidation_queue
+    cache_invalidation_queue = changes
+    bot.threaded = False
+    threading.Thread(target=apply_cache_invalidations, args=(invalidations,), daemon=True).start()
+    pool = UpdateWorkerPool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    # Процесс завершается вместе с родительским, даже если тот был убит без остановки пула
+    parent = multiprocessing.parent_process()
+    while parent.is_alive():
         try:
-            send_reminders()
-            time.sleep(3600)  # Проверка каждый час
-        except Exception as e:
-            logger.error(f"Произошла ошибка: {e}")
-            time.sleep(60)  # Подождать минуту перед повторной попыткой
+            update = updates.get(timeout=1)
+        except queue.Empty:
+            continue
+        pool.submit(update, block=True)
+
+class UpdateProcessPool:
+    # Апдейты распределяются по процессам по чату, как в UpdateWorkerPool по потокам,
+    # поэтому порядок внутри чата сохраняется. Сброс кэша подписок из любого процесса
+    # рассылается остальным, чтобы они не отвечали по устаревшему состоянию.
+    def __init__(self, processes, queue_size):
+        context = multiprocessing.get_context('spawn')
+        self.changes = context.Queue()
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(processes)]
+        self.invalidations = [context.Queue() for _ in range(processes)]
+        self.processes = [context.Process(target=run_update_process, args=(updates, self.changes, invalidations),
+                                          name=f"update-process-{i}", daemon=True)
+                          for i, (updates, invalidations) in enumerate(zip(self.queues, self.invalidations))]
+        for process in self.processes:
+            process.start()
+        threading.Thread(target=self.relay_invalidations, name='cache-invalidation-relay', daemon=True).start()
+
+    def relay_invalidations(self):
+        while True:
+            change = self.changes.get()
+            for invalidations in self.invalidations:
+                invalidations.put(change)
+
+    def submit(self, update):
+        updates = self.queues[get_update_chat_id(update) % len(self.queues)]
+        try:
+            updates.put_nowait(update)
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self):
+        return sum(updates.qsize() for updates in self.queues)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        if WEBHOOK_SECRET and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            self.send_error(403)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            update = Update.de_json(body.decode('utf-8'))
+        except Exception:
+            self.send_error(400)
+            return
+        if not self.server.update_pool.submit(update):
+            # Очередь заполнена: Telegram повторит доставку позже
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook: {format % args}")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_metrics_server():
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+# Пул обработки апдейтов в режиме вебхука, его глубина отдается в метриках
+webhook_pool = None
+
+def run_webhook():
+    # Апдейты обрабатываются пулом UpdateWorkerPool, собственный пул TeleBot нарушил бы порядок внутри чата.
+    # При UPDATE_PROCESSES > 1 апдейты распределяются по процессам, в каждом свой пул потоков.
+    global webhook_pool, cache_invalidation_queue
+    bot.threaded = False
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    if UPDATE_PROCESSES > 1:
+        webhook_pool = UpdateProcessPool(UPDATE_PROCESSES, WEBHOOK_WORKERS * WEBHOOK_QUEUE_SIZE)
+        cache_invalidation_queue = webhook_pool.changes
+    else:
+        webhook_pool = UpdateWorkerPool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    server.update_pool = webhook_pool
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                        max_connections=min(WEBHOOK_WORKERS * max(UPDATE_PROCESSES, 1), 100))
+    logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+def run_maintenance_command(command):
+    # python bot.py rebuild-subscriptions | verify-subscriptions
+    if command == 'rebuild-subscriptions':
+        with engine.begin() as connection:
+            rebuild_subscriptions(connection)
+        logger.info("Сводка subscriptions пересчитана")
+        return 0
+    if command == 'verify-subscriptions':
+        mismatched = verify_subscriptions()
+        if mismatched:
+            logger.error(f"Сводка subscriptions расходится с оплатами у {len(mismatched)} пользователей: {mismatched[:20]}")
+            return 1
+        logger.info("Сводка subscriptions совпадает с оплатами")
+        return 0
+    logger.error(f"Неизвестная команда: {command}")
+    return 2
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(run_maintenance_command(sys.argv[1]))
+
+    if METRICS_PORT:
+        run_metrics_server()
+
+    # Роль ведущего: напоминания и рассылки (в том числе прерванные перезапуском) выполняет один экземпляр
+    scheduler_lease.start()
+
     # Запускаем отправку напоминаний в отдельном потоке
     reminder_thread = threading.Thread(target=main)
     reminder_thread.start()
     
     # Запускаем бота
-    logger.info("Бот запущен")
-    bot.polling(none_stop=True, interval=0, timeout=20)
\ No newline at end of file
+    logger.info(f"Бот запущен (экземпляр {INSTANCE_ID})")
+    try:
+        if RUN_MODE == 'webhook':
+            run_webhook()
+        else:
+            bot.polling(none_stop=True, interval=0, timeout=20)
+    finally:
+        scheduler_lease.release()
\ No newline at end of file
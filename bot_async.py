@@ -0,0 +1,429 @@
+import asyncio
+import datetime
+import functools
+import logging
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, nullcontext
+from sqlalchemy import event, insert, delete
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from telebot import asyncio_helper
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import BaseMiddleware, CancelUpdate
+from telebot.types import CallbackQuery
+from telebot.util import extract_command
+
+import bot
+from bot import metrics, Payment, PaymentIntent, User
+
+# Режим asyncio: python bot_async.py
+# Апдейты принимает AsyncTeleBot, частые пользовательские действия (/start, статус, выбор периода, "Оплатил")
+# обрабатываются корутинами с асинхронной сессией SQLAlchemy, поэтому тысячи одновременных нажатий
+# в начале месяца не занимают по потоку. Остальные обработчики bot.py (админ-панель, отчеты, CSV,
+# ввод текста по состоянию чата) выполняются как есть в пуле потоков. Напоминания и рассылки
+# тоже запускаются в пуле: это долгие пакетные задачи со своим темпом отправки.
+
+logger = logging.getLogger(__name__)
+
+# Асинхронный драйвер для URL из DATABASE_URL; другой драйвер можно указать в ASYNC_DATABASE_URL
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql',
+}
+
+def get_async_database_url(database_url):
+    url = make_url(database_url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL') or get_async_database_url(bot.DATABASE_URL)
+SYNC_HANDLER_WORKERS = int(os.getenv('SYNC_HANDLER_WORKERS', '4'))  # потоков для синхронных обработчиков и задач
+
+if bot.TELEGRAM_API_URL:
+    asyncio_helper.API_URL = bot.TELEGRAM_API_URL
+
+async_bot = AsyncTeleBot(bot.BOT_TOKEN)
+sync_executor = ThreadPoolExecutor(max_workers=SYNC_HANDLER_WORKERS, thread_name_prefix='sync-handler')
+
+def run_sync(function, *args):
+    return asyncio.get_running_loop().run_in_executor(sync_executor, function, *args)
+
+# Асинхронный движок над той же базой. Сессии создаются из класса сессий bot.Session,
+# поэтому пересчет subscriptions и сброс кэша подписок при фиксации работают так же.
+# База SQLite в памяти (sqlite://) не поддерживается: у движков были бы разные базы.
+if make_url(ASYNC_DATABASE_URL).get_backend_name() == 'sqlite':
+    # По умолчанию aiosqlite открывает соединение (и поток) на каждую сессию, поэтому пул задан явно
+    engine = create_async_engine(ASYNC_DATABASE_URL,
+                                 connect_args={'timeout': bot.DB_BUSY_TIMEOUT / 1000},
+                                 poolclass=AsyncAdaptedQueuePool,
+                                 pool_size=bot.DB_POOL_SIZE,
+                                 max_overflow=bot.DB_MAX_OVERFLOW)
+    event.listen(engine.sync_engine, 'connect', bot.set_sqlite_pragmas)
+else:
+    engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=bot.DB_POOL_SIZE,
+                                 max_overflow=bot.DB_MAX_OVERFLOW, pool_pre_ping=True)
+Session = async_sessionmaker(engine, expire_on_commit=False, sync_session_class=bot.Session.class_)
+
+# В отличие от синхронного режима, транзакция не держится на весь апдейт: обработчики фиксируют
+# изменения до обращений к Bot API. SQLite допускает одного писателя, а транзакция, начатая чтением,
+# не может дождаться блокировки записи, поэтому пишущие транзакции корутин выполняются по очереди.
+write_lock = asyncio.Lock() if engine.dialect.name == 'sqlite' else nullcontext()
+
+@asynccontextmanager
+async def write_scope():
+    async with write_lock, Session() as session:
+        try:
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+
+original_process_request = asyncio_helper._process_request
+
+async def process_api_request(token, url, method='get', params=None, files=None, **kwargs):
+    # У AsyncTeleBot нет аналога apihelper.CUSTOM_REQUEST_SENDER, поэтому лимиты отправки и выключатель
+    # из bot.py применяются оберткой над функцией запроса asyncio_helper. Лимиты общие с потоками
+    # рассылок: ожидание берется в долг у того же token bucket, не блокируя цикл событий.
+    chat_id = (params or {}).get('chat_id')
+    limited = url in bot.RATE_LIMITED_METHODS
+    file_positions = bot.get_file_positions(files)
+    for attempt in range(1, bot.SEND_MAX_ATTEMPTS + 1):
+        if attempt > 1:
+            for stream, position in file_positions:
+                stream.seek(position)
+        bot.api_breaker.before_request()
+        if limited:
+            await asyncio.sleep(bot.send_bucket.reserve())
+            if chat_id is not None:
+                await asyncio.sleep(bot.chat_limiter.reserve(chat_id))
+        started = time.perf_counter()
+        try:
+            result = await original_process_request(token, url, method, dict(params) if params else params, files, **kwargs)
+        except ApiTelegramException as e:
+            bot.api_breaker.record(e.error_code < 500)
+            metrics.inc('bot_api_requests_total', (('method', url), ('status', e.error_code)))
+            retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+            if e.error_code != 429 or attempt == bot.SEND_MAX_ATTEMPTS or retry_after > bot.API_MAX_RETRY_AFTER \
+                    or file_positions is None:
+                raise
+            metrics.inc('bot_send_retries_total')
+            logger.warning(f"Превышен лимит Telegram, пауза {retry_after} с")
+            if limited:
+                bot.send_bucket.pause(retry_after)
+                await asyncio.sleep(bot.get_backoff(0))
+            else:
+                await asyncio.sleep(retry_after + bot.get_backoff(0))
+            continue
+        except Exception:
+            # Сетевые ошибки уже повторены asyncio_helper; таймаут не повторяем - сообщение могло уйти
+            bot.api_breaker.record(False)
+            metrics.inc('bot_api_requests_total', (('method', url), ('status', 'error')))
+            raise
+        bot.api_breaker.record(True)
+        metrics.inc('bot_api_requests_total', (('method', url), ('status', 200)))
+        metrics.observe('bot_api_request_seconds', time.perf_counter() - started, (('method', url),))
+        return result
+
+asyncio_helper._process_request = process_api_request
+
+def timed_handler(function):
+    labels = (('handler', function.__name__),)
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', labels)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', time.perf_counter() - started, labels)
+    return wrapper
+
+class UpdateRouter(bot.UpdateRouter):
+    # Маршруты корутин. Состояния чатов здесь не регистрируются: текст без маршрута
+    # уходит синхронному роутеру bot.py, который и проверяет состояние чата.
+    def _register(self, routes, key, admin, denied):
+        def decorator(function):
+            routes[key] = bot.Route(timed_handler(function), admin, denied)
+            return function
+        return decorator
+
+    def resolve_message(self, message):
+        command = extract_command(message.text)
+        if command is not None:
+            return self.commands.get(command.split('@')[0]), None
+        return self.texts.get(message.text), None
+
+router = UpdateRouter()
+
+class RouterMiddleware(BaseMiddleware):
+    # data['route'] - корутина для апдейта или None, если апдейт обработает синхронный бот
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    async def pre_process(self, update, data):
+        is_callback = isinstance(update, CallbackQuery)
+        if is_callback:
+            route = router.resolve_callback(update.data)
+        elif update.content_type != 'text':
+            return CancelUpdate()
+        else:
+            route, _ = router.resolve_message(update)
+        if route is not None and route.admin and update.from_user.id != bot.ADMIN_ID:
+            if route.denied and is_callback:
+                await async_bot.answer_callback_query(update.id, route.denied)
+            elif route.denied:
+                await async_bot.reply_to(update, route.denied)
+            return CancelUpdate()
+        data['route'] = route
+
+    async def post_process(self, update, data, exception):
+        pass
+
+class FloodMiddleware(BaseMiddleware):
+    # Защита от частых нажатий (bot.flood_guard) для апдейтов корутин. Апдейты синхронных обработчиков
+    # проверяет FloodMiddleware бота из bot.py, иначе повтор кнопки был бы отброшен там как дубликат.
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    async def pre_process(self, update, data):
+        if data.get('route') is None:
+            return
+        reason = bot.flood_guard.check(update)
+        if reason:
+            metrics.inc('bot_updates_dropped_total', (('reason', reason),))
+            if isinstance(update, CallbackQuery):
+                try:
+                    await async_bot.answer_callback_query(update.id, bot.DROPPED_CALLBACK_ANSWERS[reason])
+                except ApiTelegramException as e:
+                    logger.debug(f"Не удалось ответить на отброшенное нажатие: {e}")
+            return CancelUpdate()
+
+    async def post_process(self, update, data, exception):
+        pass
+
+class MetricsMiddleware(BaseMiddleware):
+    # Время обработки апдейта корутиной. Апдейты синхронных обработчиков учитывает MetricsMiddleware из bot.py.
+    # Число SQL-запросов на апдейт в этом режиме не считается: счетчики bot.py привязаны к потоку.
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    async def pre_process(self, update, data):
+        data['started'] = time.perf_counter()
+
+    async def post_process(self, update, data, exception):
+        if data.get('route') is None:
+            return
+        labels = (('type', 'callback_query' if isinstance(update, CallbackQuery) else 'message'),)
+        metrics.observe('bot_update_seconds', time.perf_counter() - data['started'], labels)
+        if exception is not None:
+            metrics.inc('bot_update_errors_total', labels)
+
+async_bot.setup_middleware(RouterMiddleware())
+async_bot.setup_middleware(FloodMiddleware())
+async_bot.setup_middleware(MetricsMiddleware())
+
+@async_bot.message_handler(content_types=['text'])
+async def dispatch_message(message, data):
+    route = data['route']
+    if route is None:
+        await run_sync(bot.bot.process_new_messages, [message])
+    else:
+        await route.handler(message)
+
+@async_bot.callback_query_handler(func=lambda call: True)
+async def dispatch_callback(call, data):
+    route = data['route']
+    if route is None:
+        await run_sync(bot.bot.process_new_callback_query, [call])
+    else:
+        await route.handler(call)
+
+async def get_subscription_state(user_id):
+    # Тот же кэш, что и у синхронных обработчиков, промах загружается асинхронной сессией
+    state, generation, verify = bot.subscription_cache.lookup(user_id)
+    if verify:
+        async with Session() as session:
+            version = await session.scalar(bot.subscription_version_query(user_id))
+        state = bot.subscription_cache.verified(user_id, state, version)
+    if state is None:
+        async with Session() as session:
+            version = await session.scalar(bot.subscription_version_query(user_id))
+            payments = (await session.execute(bot.subscription_payments_query(user_id))).all()
+        state = bot.build_subscription_state(payments, version)
+        bot.subscription_cache.store(user_id, state, generation)
+    return state
+
+async def get_last_paid_month(user_id):
+    month_key = (await get_subscription_state(user_id)).last_confirmed_month
+    if month_key:
+        return datetime.datetime.strptime(bot.key_to_month(month_key), '%Y-%m')
+    return None
+
+async def get_existing_payment_months(user_id, months):
+    return bot.filter_existing_payment_months(await get_subscription_state(user_id), months)
+
+async def add_user(user_id, username):
+    async with write_scope() as session:
+        user = await session.get(User, user_id)
+        if not user:
+            session.add(User(id=user_id, username=username))
+            bot.invalidate_subscriptions(session, [user_id])  # создаст строку в subscriptions
+        else:
+            user.username = username
+
+async def add_payment(session, user_id, total_amount, months):
+    amount_per_month = total_amount // len(months)
+    payment_date = datetime.datetime.utcnow()
+    payments = [dict(user_id=user_id, amount=amount_per_month, confirmed=False, rejected=False, month=month,
+                     month_key=bot.month_to_key(month), payment_date=payment_date)
+                for month in months]
+    bot.invalidate_subscriptions(session, [user_id])
+    return list(await session.scalars(insert(Payment).returning(Payment.id), payments))
+
+async def add_new_payment(session, user_id, amount, months):
+    # Платеж создается, только если за эти месяцы еще нет оплаты; возвращает уже оплаченные месяцы.
+    # Как и в bot.add_new_payment, проверка по базе в транзакции вставки, а не по кэшу подписки
+    await session.execute(bot.lock_subscription_query(user_id))
+    paid_keys = set(await session.scalars(bot.paid_month_keys_query(user_id, months)))
+    already_paid_months = [month for month in months if bot.month_to_key(month) in paid_keys]
+    if not already_paid_months:
+        await add_payment(session, user_id, amount, months)
+    return already_paid_months
+
+async def create_payment_intent(user_id, amount, months):
+    token = secrets.token_urlsafe(8)
+    async with write_scope() as session:
+        session.add(PaymentIntent(token=token, user_id=user_id, amount=amount,
+                                  first_month_key=bot.month_to_key(months[0]), months_count=len(months)))
+    return token
+
+async def take_payment_intent(session, token, user_id):
+    created_after = datetime.datetime.utcnow() - datetime.timedelta(seconds=bot.PAYMENT_INTENT_TTL)
+    intent = (await session.execute(delete(PaymentIntent)
+                                    .where(PaymentIntent.token == token,
+                                           PaymentIntent.user_id == user_id,
+                                           PaymentIntent.created_at >= created_after)
+                                    .returning(PaymentIntent.amount, PaymentIntent.first_month_key, PaymentIntent.months_count))).first()
+    if intent is None:
+        return None
+    first_key = intent.first_month_key
+    return intent.amount, [bot.key_to_month(key) for key in range(first_key, first_key + intent.months_count)]
+
+@router.command('start')
+async def start(message):
+    await add_user(message.from_user.id, message.from_user.username)
+    await async_bot.reply_to(message, "Привет! Я буду напоминать вам об оплате каждое первое число месяца.", reply_markup=bot.get_user_keyboard())
+    logger.info(f"Новый пользователь: {message.from_user.username} (ID: {message.from_user.id})")
+
+@router.text("📊 Статус")
+async def status_command(message):
+    state = await get_subscription_state(message.from_user.id)
+    await async_bot.reply_to(message, bot.format_status(state.last_payment))
+
+@router.text("💰 Оплатить")
+async def pay_command(message):
+    text, markup = bot.render_pay_options(await get_last_paid_month(message.from_user.id))
+    await async_bot.send_message(message.chat.id, text, reply_markup=markup)
+
+@router.callback('pay_')
+async def handle_pay_selection(call):
+    _, num_months, start_month = call.data.split('_')
+    num_months = int(num_months)
+    if not 1 <= num_months <= bot.PAY_MAX_MONTHS:
+        await async_bot.answer_callback_query(call.id)
+        return
+    amount = num_months * 100  # 100 RUB за месяц
+    months = bot.get_pay_selection_periods(start_month, num_months)
+
+    already_paid_months = await get_existing_payment_months(call.from_user.id, [month for month, _ in months])
+    if already_paid_months:
+        await async_bot.answer_callback_query(call.id, bot.format_already_paid(already_paid_months), show_alert=True)
+        return
+
+    token = await create_payment_intent(call.from_user.id, amount, [month for month, _ in months])
+    text, markup = bot.render_payment_request(token, amount, months)
+    await async_bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+
+@router.callback('paid:')
+async def handle_payment(call):
+    # Намерение забирается и платеж создается в одной транзакции
+    async with write_scope() as session:
+        intent = await take_payment_intent(session, call.data.split(':', 1)[1], call.from_user.id)
+        if intent is not None:
+            amount, months = intent
+            already_paid_months = await add_new_payment(session, call.from_user.id, amount, months)
+    if intent is None:
+        await async_bot.answer_callback_query(call.id, "Выбор периода устарел. Нажмите «💰 Оплатить» и выберите период заново.", show_alert=True)
+        await async_bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        return
+    await report_payment(call, call.from_user.id, months, already_paid_months)
+
+@router.callback('paid_')
+async def handle_legacy_payment(call):
+    _, user_id, amount, months = call.data.split('_')
+    user_id, months = int(user_id), months.split(',')
+    if user_id != call.from_user.id:
+        logger.warning(f"Пользователь {call.from_user.id} нажал кнопку оплаты пользователя {user_id}")
+        await async_bot.answer_callback_query(call.id, bot.ACCESS_DENIED, show_alert=True)
+        return
+    async with write_scope() as session:
+        already_paid_months = await add_new_payment(session, user_id, int(amount), months)
+    await report_payment(call, user_id, months, already_paid_months)
+
+async def report_payment(call, user_id, months, already_paid_months):
+    if already_paid_months:
+        await async_bot.answer_callback_query(call.id, f"Оплата за месяцы {', '.join(already_paid_months)} уже существует. Платеж не создан.", show_alert=True)
+        await async_bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        return
+
+    logger.info(f"Получена неподтвержденная оплата от пользователя {call.from_user.username} (ID: {user_id}) за месяцы: {', '.join(months)}")
+    await async_bot.answer_callback_query(call.id, "Спасибо за оплату! Администратор проверит и подтвердит её.")
+    await async_bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    bot.admin_notifier.notify(f"Новая оплата от пользователя {call.from_user.username} (ID: {user_id}) за месяцы: {', '.join(months)}. Используйте команду '✅ Подтвердить оплаты' для подтверждения.")
+
+async def run_scheduler():
+    # Аренда ведущего и расписание напоминаний как задача цикла событий; сами задачи выполняются в пуле
+    jobs = None
+    next_check = 0
+    while True:
+        if await run_sync(bot.scheduler_lease.renew):
+            try:
+                await run_sync(bot.resume_broadcasts)
+            except Exception as e:
+                logger.error(f"Не удалось возобновить рассылки: {e}")
+            if (jobs is None or jobs.done()) and time.monotonic() >= next_check:
+                jobs = run_sync(bot.run_scheduled_jobs)
+                next_check = time.monotonic() + bot.REMINDER_CHECK_INTERVAL
+        else:
+            # Новый ведущий проверяет расписание сразу после получения роли
+            next_check = 0
+        await asyncio.sleep(bot.LEASE_RENEW_INTERVAL)
+
+async def run():
+    scheduler = asyncio.create_task(run_scheduler())
+    try:
+        await async_bot.polling(non_stop=True, interval=0, timeout=20)
+    finally:
+        scheduler.cancel()
+        await run_sync(bot.scheduler_lease.release)
+        await engine.dispose()
+
+if __name__ == '__main__':
+    # Синхронные обработчики вызываются из пула sync_executor, собственный пул TeleBot не нужен
+    bot.bot.threaded = False
+    if bot.METRICS_PORT:
+        bot.run_metrics_server()
+    logger.info(f"Бот запущен в режиме asyncio (экземпляр {bot.INSTANCE_ID})")
+    asyncio.run(run())